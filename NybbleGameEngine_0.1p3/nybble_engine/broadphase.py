@@ -0,0 +1,933 @@
+from abc import ABCMeta
+from abc import abstractmethod
+
+from math import floor
+
+
+# A broadphase sits between the motion integration and the narrowphase
+# of the physics system. It cheaply finds the pairs of entities whose colliders
+# may be touching so only those pairs get the exact (and expensive) collision tests.
+class Broadphase (object):
+    __metaclass__ = ABCMeta
+
+    def __init__(self):
+        # A reference to the world whose colliders are indexed.
+        self.world = None
+
+    # An entity is dynamic if the physics system has to move it or resolve its collisions.
+    @staticmethod
+    def is_dynamic(entity):
+        return entity.rigid_body is not None or entity.collider.treat_as_dynamic
+
+    # The bounds of the entity's collider enlarged by the distance its rigid body travels
+    # in this frame. The physics system moves a body after the broadphase indexed it, so
+    # the pairs must still be found at the integrated position.
+    def get_swept_bounds(self, entity):
+        left, top, right, bottom = entity.collider.get_bounds()
+
+        rigid_body = entity.rigid_body
+        if rigid_body is not None:
+            dt = self.world.engine.delta_time
+
+            # grow in both directions since a collision may invert the velocity
+            dx = abs(rigid_body.velocity.x * dt)
+            dy = abs(rigid_body.velocity.y * dt)
+
+            left -= dx
+            right += dx
+            top -= dy
+            bottom += dy
+
+        return left, top, right, bottom
+
+    # The versions of the transform and the collider of an entity that stands still in this frame.
+    # None for a body with a velocity, since its swept bounds depend on more than its transform.
+    # An entity with the same versions as in the last update has the same bounds, so it can be skipped.
+    @staticmethod
+    def get_rest_versions(entity):
+        rigid_body = entity.rigid_body
+        if rigid_body is not None and (rigid_body.velocity.x or rigid_body.velocity.y):
+            return None
+
+        return entity.transform.version, entity.collider.version
+
+    # Filter the pairs by collision layers before their bounds are compared. The category of each
+    # collider has to be in the mask of the other and the world has to let their layers collide.
+    def can_collide(self, entity_a, entity_b):
+        collider_a = entity_a.collider
+        collider_b = entity_b.collider
+
+        if not collider_a.category & collider_b.mask or not collider_b.category & collider_a.mask:
+            return False
+
+        return self.world is None or self.world.layers_collide(collider_a.category, collider_b.category)
+
+    @abstractmethod
+    def update(self, entities):
+        """
+        Index the colliders of the enabled entities for the current frame.
+        """
+
+    @abstractmethod
+    def get_pairs(self):
+        """
+        Return a list of unordered (entity_a, entity_b) candidate pairs.
+        Each pair is reported once and at least one of the entities is dynamic.
+        """
+
+    @abstractmethod
+    def query(self, bounds):
+        """
+        Return the entities whose indexed bounds overlap the (left, top, right, bottom) bounds.
+        """
+
+    @abstractmethod
+    def get_extent(self):
+        """
+        Return the bounds that contain every indexed collider, None if nothing is indexed.
+        """
+
+    # Return the entities whose indexed bounds the segment from (x, y) to (x + dx, y + dy) may cross
+    def query_segment(self, x, y, dx, dy):
+        return self.query((min(x, x + dx), min(y, y + dy), max(x, x + dx), max(y, y + dy)))
+
+
+# Uniform grid spatial hash. Every collider is hashed into all of the cells its bounds
+# cover, so only colliders that share a cell become candidate pairs.
+class SpatialHashBroadphase (Broadphase):
+
+    def __init__(self, cell_size=None):
+        super(SpatialHashBroadphase, self).__init__()
+
+        # The width and height of a cell. None means to use the cell size of the world.
+        self.cell_size = cell_size
+
+        # Maps the (x, y) cell coordinates to a pair of lists: [dynamic entities, static entities]
+        self.cells = dict()
+
+        # Maps entity uuids to the bounds they were hashed with
+        self.bounds = dict()
+
+        # the bounds that contain every hashed collider
+        self.extent = None
+
+    def update(self, entities):
+
+        cell_size = self.cell_size
+        if cell_size is None:
+            cell_size = self.world.cell_size
+
+        cells = self.cells
+        cells.clear()
+        self.bounds.clear()
+        self.extent = None
+
+        for e in entities:
+
+            if e.disabled or e.collider is None:
+                continue
+
+            # index 0 holds the dynamic entities, index 1 the static ones
+            index = 0 if Broadphase.is_dynamic(e) else 1
+
+            bounds = self.get_swept_bounds(e)
+            left, top, right, bottom = bounds
+
+            self.bounds[e.uuid] = bounds
+            self.extent = bounds if self.extent is None else bounds_union(self.extent, bounds)
+
+            # range of cells that the bounds cover
+            x_start = int(floor(left / cell_size))
+            x_end = int(floor(right / cell_size))
+            y_start = int(floor(top / cell_size))
+            y_end = int(floor(bottom / cell_size))
+
+            for cx in range(x_start, x_end + 1):
+                for cy in range(y_start, y_end + 1):
+
+                    cell = cells.get((cx, cy))
+
+                    # first collider in this cell
+                    if cell is None:
+                        cell = ([], [])
+                        cells[(cx, cy)] = cell
+
+                    cell[index].append(e)
+
+    def get_pairs(self):
+
+        pairs = list()
+
+        # A collider that spans several cells would otherwise report the same pair more than once
+        reported = set()
+
+        for dynamic, static in self.cells.values():
+
+            n = len(dynamic)
+
+            for i in range(0, n):
+                e_a = dynamic[i]
+                uuid_a = e_a.uuid
+
+                # dynamic vs dynamic
+                for j in range(i + 1, n):
+                    e_b = dynamic[j]
+                    uuid_b = e_b.uuid
+
+                    key = (uuid_a, uuid_b) if uuid_a < uuid_b else (uuid_b, uuid_a)
+                    if key not in reported:
+                        reported.add(key)
+
+                        if self.can_collide(e_a, e_b):
+                            pairs.append((e_a, e_b))
+
+                # dynamic vs static - static colliders are never tested against each other
+                for e_b in static:
+                    uuid_b = e_b.uuid
+
+                    key = (uuid_a, uuid_b) if uuid_a < uuid_b else (uuid_b, uuid_a)
+                    if key not in reported:
+                        reported.add(key)
+
+                        if self.can_collide(e_a, e_b):
+                            pairs.append((e_a, e_b))
+
+        return pairs
+
+    def query(self, bounds):
+
+        cell_size = self.cell_size
+        if cell_size is None:
+            cell_size = self.world.cell_size
+
+        result = list()
+        found = set()
+
+        for cx in range(int(floor(bounds[0] / cell_size)), int(floor(bounds[2] / cell_size)) + 1):
+            for cy in range(int(floor(bounds[1] / cell_size)), int(floor(bounds[3] / cell_size)) + 1):
+
+                cell = self.cells.get((cx, cy))
+                if cell is None:
+                    continue
+
+                for entities in cell:
+                    for e in entities:
+                        if e.uuid not in found and bounds_overlap(self.bounds[e.uuid], bounds):
+                            found.add(e.uuid)
+                            result.append(e)
+
+        return result
+
+    def get_extent(self):
+        return self.extent
+
+
+# Sweep and prune keeps the min/max endpoints of every collider's bounds sorted along one axis.
+# Colliders move only a little between frames, so the endpoint list stays nearly sorted and
+# insertion sort restores it in close to linear time. A sweep over the sorted endpoints then
+# reports the colliders whose intervals overlap on that axis and on the other one.
+# No tuning is needed, but it works best when the colliders are spread out along the sorting axis.
+class SweepAndPruneBroadphase (Broadphase):
+
+    x_axis = 0
+    y_axis = 1
+
+    # Tracks the bounds and the endpoints of an indexed collider
+    class Proxy(object):
+
+        def __init__(self, entity):
+            self.entity = entity
+
+            # (left, top, right, bottom) of the collider
+            self.bounds = None
+            self.dynamic = False
+
+            # the last update that refreshed this proxy
+            self.stamp = 0
+
+            # the versions of the entity when it last stood still, see get_rest_versions()
+            self.versions = None
+
+            # endpoints along the sorting axis as [value, is_max, proxy] lists
+            self.min_point = [0, False, self]
+            self.max_point = [0, True, self]
+
+    def __init__(self, axis=x_axis):
+        super(SweepAndPruneBroadphase, self).__init__()
+
+        # The axis to sort the endpoints along. Use the axis that the colliders
+        # are spread out along the most, such as the x axis for platformer levels.
+        self.axis = axis
+
+        # Maps entity uuids to their proxies
+        self.proxies = dict()
+
+        # The endpoints of every proxy sorted along the axis
+        self.endpoints = list()
+
+        # the bounds that contain every proxy
+        self.extent = None
+
+        # The largest size of a proxy along the axis. A query only visits the min endpoints
+        # that are at most this far before the query bounds.
+        self.max_size = 0
+
+        self.stamp = 0
+
+    def update(self, entities):
+
+        self.stamp += 1
+
+        axis = self.axis
+        added = 0
+
+        self.extent = None
+        max_size = 0
+
+        for e in entities:
+
+            if e.disabled or e.collider is None:
+                continue
+
+            proxy = self.proxies.get(e.uuid)
+
+            # Ids are recycled, so a new entity may own the uuid of a removed one
+            if proxy is None or proxy.entity is not e:
+                proxy = SweepAndPruneBroadphase.Proxy(e)
+                self.proxies[e.uuid] = proxy
+                self.endpoints.append(proxy.min_point)
+                self.endpoints.append(proxy.max_point)
+                added += 2
+
+            proxy.dynamic = Broadphase.is_dynamic(e)
+            proxy.stamp = self.stamp
+
+            # the endpoints of an entity that did not move are still in place
+            versions = Broadphase.get_rest_versions(e)
+            if versions is not None and versions == proxy.versions:
+                self.extent = proxy.bounds if self.extent is None else bounds_union(self.extent, proxy.bounds)
+                max_size = max(max_size, proxy.bounds[axis + 2] - proxy.bounds[axis])
+                continue
+
+            proxy.versions = versions
+
+            bounds = self.get_swept_bounds(e)
+
+            proxy.bounds = bounds
+            proxy.min_point[0] = bounds[axis]
+            proxy.max_point[0] = bounds[axis + 2]
+
+            self.extent = bounds if self.extent is None else bounds_union(self.extent, bounds)
+            max_size = max(max_size, bounds[axis + 2] - bounds[axis])
+
+        self.max_size = max_size
+
+        # remove the endpoints of the entities that were destroyed, disabled or lost their collider
+        stamp = self.stamp
+        stale = [uuid for uuid, proxy in self.proxies.items() if proxy.stamp != stamp]
+        for uuid in stale:
+            del self.proxies[uuid]
+
+        if len(self.endpoints) != 2 * len(self.proxies):
+            self.endpoints = [point for point in self.endpoints if point[2].stamp == stamp]
+
+        # Loading a scene appends a lot of unsorted endpoints at once which would make
+        # the insertion sort quadratic, so sort those from scratch.
+        if added > len(self.endpoints) / 2:
+            self.endpoints.sort(key=lambda point: (point[0], point[1]))
+        else:
+            SweepAndPruneBroadphase._insertion_sort(self.endpoints)
+
+    # Sort the endpoints by value. On equal values a min endpoint goes before a max endpoint
+    # so touching bounds are still reported as overlapping.
+    @staticmethod
+    def _insertion_sort(points):
+
+        for i in range(1, len(points)):
+
+            point = points[i]
+            value = point[0]
+            is_max = point[1]
+
+            # shift the greater endpoints to the right
+            j = i - 1
+            while j >= 0:
+                other = points[j]
+
+                if other[0] < value or (other[0] == value and other[1] <= is_max):
+                    break
+
+                points[j + 1] = other
+                j -= 1
+
+            points[j + 1] = point
+
+    def get_pairs(self):
+
+        pairs = list()
+
+        # the bounds indices of the other axis
+        low = 1 - self.axis
+        high = low + 2
+
+        # proxies whose interval along the sorting axis contains the current endpoint
+        active = list()
+
+        for value, is_max, proxy in self.endpoints:
+
+            # the interval of the proxy ended
+            if is_max:
+                active.remove(proxy)
+                continue
+
+            bounds = proxy.bounds
+
+            for other in active:
+
+                # static colliders are never tested against each other
+                if not proxy.dynamic and not other.dynamic:
+                    continue
+
+                if not self.can_collide(proxy.entity, other.entity):
+                    continue
+
+                # they overlap on the sorting axis, check the other axis
+                other_bounds = other.bounds
+                if bounds[low] <= other_bounds[high] and other_bounds[low] <= bounds[high]:
+                    pairs.append((other.entity, proxy.entity))
+
+            active.append(proxy)
+
+        return pairs
+
+    # Only the min endpoints between the start of the query minus the largest proxy size and
+    # the end of the query can belong to overlapping proxies, both ends are binary searched
+    def query(self, bounds):
+
+        endpoints = self.endpoints
+
+        first = SweepAndPruneBroadphase._search(endpoints, bounds[self.axis] - self.max_size, False)
+        last = SweepAndPruneBroadphase._search(endpoints, bounds[self.axis + 2], True)
+
+        result = list()
+        for i in range(first, last):
+            value, is_max, proxy = endpoints[i]
+            if not is_max and bounds_overlap(proxy.bounds, bounds):
+                result.append(proxy.entity)
+
+        return result
+
+    # The index of the first endpoint past the value along the axis, or of the first one
+    # at the value unless inclusive is set
+    @staticmethod
+    def _search(endpoints, value, inclusive):
+
+        first = 0
+        last = len(endpoints)
+        while first < last:
+            middle = (first + last) // 2
+            if endpoints[middle][0] < value or (inclusive and endpoints[middle][0] == value):
+                first = middle + 1
+            else:
+                last = middle
+
+        return first
+
+    def get_extent(self):
+        return self.extent
+
+
+# ------- bounds utilities. Bounds are (left, top, right, bottom) tuples ------- #
+
+def bounds_overlap(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+# test if the inner bounds are completely inside the outer bounds
+def bounds_contain(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+
+def bounds_union(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+# Tell if the segment from (x, y) to (x + dx, y + dy) crosses the bounds
+def segment_overlaps_bounds(x, y, dx, dy, bounds):
+
+    t_enter = 0.0
+    t_exit = 1.0
+
+    for p, d, low, high in ((x, dx, bounds[0], bounds[2]), (y, dy, bounds[1], bounds[3])):
+
+        if d == 0:
+            if p < low or p > high:
+                return False
+            continue
+
+        t_low = (low - p) / d
+        t_high = (high - p) / d
+
+        if t_low > t_high:
+            t_low, t_high = t_high, t_low
+
+        t_enter = max(t_enter, t_low)
+        t_exit = min(t_exit, t_high)
+
+        if t_enter > t_exit:
+            return False
+
+    return True
+
+
+def bounds_perimeter(a):
+    return 2 * ((a[2] - a[0]) + (a[3] - a[1]))
+
+
+# Dynamic bounding volume hierarchy of the colliders. Every collider is a leaf holding fattened
+# bounds and the internal nodes hold the union of their children. Queries are logarithmic regardless
+# of the size differences between the colliders, which is where a uniform grid struggles.
+# A leaf is only re-inserted when its collider leaves the fat bounds, so slow or resting bodies
+# leave the tree untouched.
+class DynamicTreeBroadphase (Broadphase):
+
+    class Node(object):
+
+        def __init__(self):
+            # The fat bounds for leaves, union of the children bounds otherwise
+            self.bounds = None
+
+            self.parent = None
+            self.child1 = None
+            self.child2 = None
+
+            # leaves have a height of 0
+            self.height = 0
+
+            # ------- leaf data ------- #
+            self.entity = None
+            self.dynamic = False
+
+            # the actual bounds of the collider in this frame
+            self.tight_bounds = None
+
+            # the last update that refreshed this leaf
+            self.stamp = 0
+
+            # the versions of the entity when it last stood still, see get_rest_versions()
+            self.versions = None
+
+        def is_leaf(self):
+            return self.child1 is None
+
+    def __init__(self, margin=8):
+        super(DynamicTreeBroadphase, self).__init__()
+
+        # How much to enlarge the bounds of a leaf. Larger values mean fewer
+        # re-insertions but more candidate pairs.
+        self.margin = margin
+
+        self.root = None
+
+        # Maps entity uuids to their leaves
+        self.leaves = dict()
+
+        # The leaves that query the tree for pairs, in entity order
+        self.dynamic_leaves = list()
+
+        self.stamp = 0
+
+    def update(self, entities):
+
+        self.stamp += 1
+        del self.dynamic_leaves[:]
+
+        margin = self.margin
+
+        for e in entities:
+
+            if e.disabled or e.collider is None:
+                continue
+
+            leaf = self.leaves.get(e.uuid)
+            inserted = False
+
+            # Ids are recycled, so a new entity may own the uuid of a removed one
+            if leaf is None or leaf.entity is not e:
+
+                if leaf is not None:
+                    self._remove_leaf(leaf)
+
+                leaf = DynamicTreeBroadphase.Node()
+                leaf.entity = e
+                self.leaves[e.uuid] = leaf
+                inserted = True
+
+            leaf.dynamic = Broadphase.is_dynamic(e)
+            leaf.stamp = self.stamp
+
+            # the leaf of an entity that did not move is still in place
+            versions = Broadphase.get_rest_versions(e)
+            if not inserted and versions is not None and versions == leaf.versions:
+                if leaf.dynamic:
+                    self.dynamic_leaves.append(leaf)
+                continue
+
+            leaf.versions = versions
+
+            tight = self.get_swept_bounds(e)
+            leaf.tight_bounds = tight
+
+            # re-insert the leaf only if the collider escaped its fat bounds
+            if inserted or not bounds_contain(leaf.bounds, tight):
+
+                if not inserted:
+                    self._remove_leaf(leaf)
+
+                leaf.bounds = (tight[0] - margin, tight[1] - margin, tight[2] + margin, tight[3] + margin)
+                self._insert_leaf(leaf)
+
+            if leaf.dynamic:
+                self.dynamic_leaves.append(leaf)
+
+        # remove the leaves of the entities that were destroyed, disabled or lost their collider
+        stale = [uuid for uuid, leaf in self.leaves.items() if leaf.stamp != self.stamp]
+        for uuid in stale:
+            self._remove_leaf(self.leaves.pop(uuid))
+
+    def get_pairs(self):
+
+        pairs = list()
+
+        if self.root is None:
+            return pairs
+
+        for leaf in self.dynamic_leaves:
+
+            tight = leaf.tight_bounds
+            uuid = leaf.entity.uuid
+
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+
+                if not bounds_overlap(node.bounds, tight):
+                    continue
+
+                if not node.is_leaf():
+                    stack.append(node.child1)
+                    stack.append(node.child2)
+                    continue
+
+                if node is leaf:
+                    continue
+
+                # a pair of dynamic leaves is reported by the one with the smaller uuid
+                if node.dynamic and node.entity.uuid < uuid:
+                    continue
+
+                if not self.can_collide(leaf.entity, node.entity):
+                    continue
+
+                # compare the actual bounds so both leaves of a pair agree on it
+                if bounds_overlap(node.tight_bounds, tight):
+                    pairs.append((leaf.entity, node.entity))
+
+        return pairs
+
+    # Add the collider of an entity outside of update. Used by indexes whose colliders
+    # are rarely added or removed such as the baked static colliders of the physics system.
+    def insert(self, entity):
+
+        self.remove(entity)
+
+        tight = self.get_swept_bounds(entity)
+        margin = self.margin
+
+        leaf = DynamicTreeBroadphase.Node()
+        leaf.entity = entity
+        leaf.dynamic = Broadphase.is_dynamic(entity)
+        leaf.tight_bounds = tight
+        leaf.bounds = (tight[0] - margin, tight[1] - margin, tight[2] + margin, tight[3] + margin)
+
+        self.leaves[entity.uuid] = leaf
+        self._insert_leaf(leaf)
+
+    # Remove the collider of an entity if it is in the tree
+    def remove(self, entity):
+        leaf = self.leaves.get(entity.uuid)
+
+        if leaf is not None and leaf.entity is entity:
+            del self.leaves[entity.uuid]
+            self._remove_leaf(leaf)
+
+    def contains(self, entity):
+        leaf = self.leaves.get(entity.uuid)
+        return leaf is not None and leaf.entity is entity
+
+    # The bounds the collider of the entity had when it was last indexed, or None if it is not indexed
+    def get_indexed_bounds(self, entity):
+        leaf = self.leaves.get(entity.uuid)
+        if leaf is None or leaf.entity is not entity:
+            return None
+        return leaf.tight_bounds
+
+    def clear(self):
+        self.root = None
+        self.leaves.clear()
+        del self.dynamic_leaves[:]
+
+    # Return the entities whose collider bounds overlap the given bounds
+    def query(self, bounds):
+
+        result = list()
+
+        if self.root is None:
+            return result
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+
+            if not bounds_overlap(node.bounds, bounds):
+                continue
+
+            if not node.is_leaf():
+                stack.append(node.child1)
+                stack.append(node.child2)
+
+            elif bounds_overlap(node.tight_bounds, bounds):
+                result.append(node.entity)
+
+        return result
+
+    # Only descend into the nodes that the segment crosses
+    def query_segment(self, x, y, dx, dy):
+
+        result = list()
+
+        if self.root is None:
+            return result
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+
+            if not segment_overlaps_bounds(x, y, dx, dy, node.bounds):
+                continue
+
+            if not node.is_leaf():
+                stack.append(node.child1)
+                stack.append(node.child2)
+
+            elif segment_overlaps_bounds(x, y, dx, dy, node.tight_bounds):
+                result.append(node.entity)
+
+        return result
+
+    def get_extent(self):
+        if self.root is None:
+            return None
+        return self.root.bounds
+
+    def _insert_leaf(self, leaf):
+
+        if self.root is None:
+            self.root = leaf
+            leaf.parent = None
+            return
+
+        bounds = leaf.bounds
+
+        # Find the best sibling for the leaf by descending the tree and
+        # choosing the child that grows the least in perimeter.
+        node = self.root
+        while not node.is_leaf():
+
+            perimeter = bounds_perimeter(node.bounds)
+            combined_perimeter = bounds_perimeter(bounds_union(node.bounds, bounds))
+
+            # cost of creating a new parent for this node and the new leaf
+            cost = 2 * combined_perimeter
+
+            # minimum cost of pushing the leaf further down the tree
+            inheritance_cost = 2 * (combined_perimeter - perimeter)
+
+            cost1 = DynamicTreeBroadphase._descend_cost(node.child1, bounds) + inheritance_cost
+            cost2 = DynamicTreeBroadphase._descend_cost(node.child2, bounds) + inheritance_cost
+
+            if cost < cost1 and cost < cost2:
+                break
+
+            node = node.child1 if cost1 < cost2 else node.child2
+
+        sibling = node
+
+        # create a new parent for the sibling and the leaf
+        old_parent = sibling.parent
+        new_parent = DynamicTreeBroadphase.Node()
+        new_parent.parent = old_parent
+        new_parent.bounds = bounds_union(bounds, sibling.bounds)
+        new_parent.height = sibling.height + 1
+
+        if old_parent is not None:
+            if old_parent.child1 is sibling:
+                old_parent.child1 = new_parent
+            else:
+                old_parent.child2 = new_parent
+
+        # the sibling was the root
+        else:
+            self.root = new_parent
+
+        new_parent.child1 = sibling
+        new_parent.child2 = leaf
+        sibling.parent = new_parent
+        leaf.parent = new_parent
+
+        # walk back up the tree fixing the heights and bounds
+        self._refit(leaf.parent)
+
+    @staticmethod
+    def _descend_cost(child, bounds):
+        if child.is_leaf():
+            return bounds_perimeter(bounds_union(bounds, child.bounds))
+
+        return bounds_perimeter(bounds_union(bounds, child.bounds)) - bounds_perimeter(child.bounds)
+
+    def _remove_leaf(self, leaf):
+
+        if leaf is self.root:
+            self.root = None
+            return
+
+        parent = leaf.parent
+        grand_parent = parent.parent
+        sibling = parent.child2 if parent.child1 is leaf else parent.child1
+
+        # replace the parent with the sibling
+        if grand_parent is not None:
+            if grand_parent.child1 is parent:
+                grand_parent.child1 = sibling
+            else:
+                grand_parent.child2 = sibling
+
+            sibling.parent = grand_parent
+            self._refit(grand_parent)
+
+        else:
+            self.root = sibling
+            sibling.parent = None
+
+        leaf.parent = None
+
+    # Balance and update the bounds and heights from the node up to the root
+    def _refit(self, node):
+        while node is not None:
+            node = self._balance(node)
+
+            child1 = node.child1
+            child2 = node.child2
+
+            node.height = 1 + max(child1.height, child2.height)
+            node.bounds = bounds_union(child1.bounds, child2.bounds)
+
+            node = node.parent
+
+    # Perform a left or right rotation if node a is imbalanced.
+    # Returns the new root of the sub tree.
+    def _balance(self, a):
+
+        if a.is_leaf() or a.height < 2:
+            return a
+
+        b = a.child1
+        c = a.child2
+
+        balance = c.height - b.height
+
+        # rotate c up
+        if balance > 1:
+            f = c.child1
+            g = c.child2
+
+            # swap a and c
+            c.child1 = a
+            c.parent = a.parent
+            a.parent = c
+
+            # a's old parent should point to c
+            self._replace_child(c.parent, a, c)
+
+            # rotate
+            if f.height > g.height:
+                c.child2 = f
+                a.child2 = g
+                g.parent = a
+                a.bounds = bounds_union(b.bounds, g.bounds)
+                c.bounds = bounds_union(a.bounds, f.bounds)
+
+                a.height = 1 + max(b.height, g.height)
+                c.height = 1 + max(a.height, f.height)
+
+            else:
+                c.child2 = g
+                a.child2 = f
+                f.parent = a
+                a.bounds = bounds_union(b.bounds, f.bounds)
+                c.bounds = bounds_union(a.bounds, g.bounds)
+
+                a.height = 1 + max(b.height, f.height)
+                c.height = 1 + max(a.height, g.height)
+
+            return c
+
+        # rotate b up
+        if balance < -1:
+            d = b.child1
+            e = b.child2
+
+            # swap a and b
+            b.child1 = a
+            b.parent = a.parent
+            a.parent = b
+
+            # a's old parent should point to b
+            self._replace_child(b.parent, a, b)
+
+            # rotate
+            if d.height > e.height:
+                b.child2 = d
+                a.child1 = e
+                e.parent = a
+                a.bounds = bounds_union(c.bounds, e.bounds)
+                b.bounds = bounds_union(a.bounds, d.bounds)
+
+                a.height = 1 + max(c.height, e.height)
+                b.height = 1 + max(a.height, d.height)
+
+            else:
+                b.child2 = e
+                a.child1 = d
+                d.parent = a
+                a.bounds = bounds_union(c.bounds, d.bounds)
+                b.bounds = bounds_union(a.bounds, e.bounds)
+
+                a.height = 1 + max(c.height, d.height)
+                b.height = 1 + max(a.height, e.height)
+
+            return b
+
+        return a
+
+    def _replace_child(self, parent, old_child, new_child):
+
+        # the old child was the root
+        if parent is None:
+            self.root = new_child
+
+        elif parent.child1 is old_child:
+            parent.child1 = new_child
+
+        else:
+            parent.child2 = new_child
@@ -1,7 +1,15 @@
 from pygame import Rect
+from pygame import Surface, SRCALPHA
+from pygame import draw
+from pygame.mask import Mask, from_surface
 from abc import ABCMeta
 
+import weakref
+
 from util_math import Vector2
+from util_math import get_relative_rect_pos
+
+from math import floor, sqrt, sin, cos, radians
 
 from pygame import transform
 
@@ -28,6 +36,39 @@ class Transform (Component):
         self.degrees = degrees
         self.scale = Vector2(x_scale, y_scale)
 
+        # The (x, y) position at the previous fixed step. The render system
+        # interpolates between it and the current position.
+        self.previous_position = None
+
+        # Bumped every time the position, the rotation or the scale changes. Values computed from the transform,
+        # such as the bounds of the collider, are cached along with the version they were computed for.
+        # Scripts write to the position directly, so the physics system also compares every moving
+        # transform to its last state once per step with check_changed().
+        self.version = 0
+        self._last_state = None
+
+    # Let the cached values computed from the transform know that it changed
+    def mark_changed(self):
+        self.version += 1
+        self._notify_changed()
+
+    # Bump the version if the position, the rotation or the scale changed since the last check
+    def check_changed(self):
+        position = self.position
+        scale = self.scale
+
+        state = (position.x, position.y, self.degrees, scale.x, scale.y)
+        if state != self._last_state:
+            self._last_state = state
+            self.version += 1
+            self._notify_changed()
+
+    # The render system indexes the renderers without a rigid body by where they are, so it has to know when they move
+    def _notify_changed(self):
+        entity = self.entity
+        if entity is not None and entity.rigid_body is None and entity.renderer is not None and entity.world is not None:
+            entity.world._transform_changed(entity)
+
     # Even though the render system should handle this logic, it would do it at very
     # rendering update but these scaling operations on surface are expensive. To fix
     # this, the logic has been done here for efficiency purposes.
@@ -35,6 +76,7 @@ class Transform (Component):
 
         # update the scale vector
         self.scale = Vector2(x_scale, y_scale)
+        self.mark_changed()
 
         # transform the renderer's attributes
         renderer = self.entity.renderer
@@ -68,6 +110,12 @@ class Transform (Component):
             collider.offset.x = x_scale * collider.original_offset.x
             collider.offset.y = y_scale * collider.original_offset.y
 
+            collider.mark_changed()
+
+        # the bounds of the collider and of the sprite changed
+        if self.entity.world is not None:
+            self.entity.world._colliders_changed(self.entity)
+
 
 # Contains image to render
 # pivot is of type Vector2 - it is the position relative to the image
@@ -92,6 +140,13 @@ class Renderer (Component):
         # if the renderer is affected by the camera
         self.is_static = False
 
+        # Bumped when the sprite is drawn on in place, so the render system
+        # knows to draw it again when it only redraws what changed.
+        self.version = 0
+
+    def mark_changed(self):
+        self.version += 1
+
     # scale the destination image surface relative to the
     # source image.
     @staticmethod
@@ -120,6 +175,7 @@ class Renderer (Component):
     def set_color(self, color):
         self.original_image.fill(color)
         self.sprite.fill(color)
+        self.mark_changed()
 
 
 # Only holds velocity vector and mass scalar, may be expanded in future development
@@ -137,6 +193,26 @@ class RigidBody (Component):
 
         self.gravity_enabled = False
 
+        # A sleeping body is not moved nor resolved by the physics system until something wakes it up.
+        # These are managed by the physics system.
+        self.sleeping = False
+
+        # number of consecutive frames the body has been slower than the sleep speed while touching something
+        self.sleep_timer = 0
+
+        # number of frames since the body last touched something
+        self.untouched_frames = 0
+
+        # the entities that went to sleep along with this body and the position it fell asleep at
+        self.island = None
+        self.sleep_position = None
+
+        # Continuous collision detection. A fast body that moves more than its own size in a frame
+        # can skip over a thin collider. A continuous body sweeps its bounds along its motion and
+        # stops at the first collider it would hit. It costs more so only enable it for bodies
+        # that need it, such as bullets.
+        self.continuous = False
+
         # self.fixed_angle = True
         # self.angular_velocity = Vector2(0, 0)
         # self.angular_drag = 0
@@ -145,6 +221,12 @@ class RigidBody (Component):
 class Collider(Component):
     tag = "collider"
 
+    # the bits of every collision layer
+    all_layers = 0xFFFFFFFF
+
+    # Pixel perfect colliders compare the pixels of their masks once their boxes overlap
+    pixel_perfect = False
+
     def __init__(self):
         super(Collider, self).__init__()
 
@@ -171,9 +253,52 @@ class Collider(Component):
         self.offset = Vector2(0.0, 0.0)
         self.original_offset = Vector2(0, 0)
 
+        # Collision layers. The category holds the bits of the layers this collider belongs to
+        # and the mask holds the bits of the layers it can collide with. Two colliders are only
+        # tested for collision if the category of each one is in the mask of the other.
+        # A collider without a category or a mask never collides.
+        self.category = 1
+        self.mask = Collider.all_layers
+
+        # Bumped when the shape or the offset of the collider changes. The bounds are cached
+        # along with the versions of the transform and the collider they were computed for.
+        self.version = 0
+        self._bounds = None
+        self._bounds_versions = None
+
     def set_offset(self, x, y):
         self.original_offset = Vector2(x, y)
         self.offset = Vector2(x, y)
+        self.mark_changed()
+
+    # Let the cached bounds know that the shape or the offset changed.
+    # Call it after changing them directly, such as the radius of a circle.
+    def mark_changed(self):
+        self.version += 1
+
+    # Place the collider in a single layer, from 0 to 31
+    def set_layer(self, layer):
+        self.category = 1 << layer
+
+    # Tell if the collider can collide with colliders at all
+    def has_layers(self):
+        return self.category != 0 and self.mask != 0
+
+    # The axis aligned bounds of the collider in world space as a
+    # (left, top, right, bottom) tuple. Used by the physics broadphase.
+    # Only recomputed when the transform or the collider changed.
+    def get_bounds(self):
+        versions = (self.entity.transform.version, self.version)
+
+        if versions != self._bounds_versions:
+            self._bounds = self.compute_bounds()
+            self._bounds_versions = versions
+
+        return self._bounds
+
+    def compute_bounds(self):
+        position = self.entity.transform.position
+        return position.x, position.y, position.x, position.y
 
 
 class BoxCollider (Collider):
@@ -196,10 +321,14 @@ class BoxCollider (Collider):
 
         self.tolerance_hitbox.center = (self.offset.to_tuple())
 
+        # the box placed for the cached bounds, the tolerance hit box takes the place of the box at times
+        self._placed_box = None
+
     def set_box(self, width, height):
         self.box = Rect(0, 0, width, height)
         self.tolerance_hitbox = Rect(0, 0, width+self.tolerance, height+self.tolerance)
         self.tolerance_hitbox.center = (self.offset.to_tuple())
+        self.mark_changed()
 
     def scale_box_by(self, x_scale, y_scale):
 
@@ -209,6 +338,83 @@ class BoxCollider (Collider):
         self.tolerance_hitbox.w *= abs(x_scale)
         self.tolerance_hitbox.h *= abs(y_scale)
 
+        self.mark_changed()
+
+    # Place the box relative to the transform position, unless neither the transform
+    # nor the collider changed since this box was placed.
+    def place_box(self):
+        transform = self.entity.transform
+        box = self.box
+
+        if box is not self._placed_box or (transform.version, self.version) != self._bounds_versions:
+            get_relative_rect_pos(transform.position, self)
+
+            self._placed_box = box
+            self._bounds = box.left, box.top, box.right, box.bottom
+            self._bounds_versions = (transform.version, self.version)
+
+    def get_bounds(self):
+        self.place_box()
+        return self._bounds
+
+
+# A box collider that only collides where its sprite is opaque, for sprites with large transparent margins.
+# The box of the sprite is tested first and the pixels are only compared when the boxes overlap.
+# The masks are built from the sprite of the renderer once and shared by every mask collider. Scaled and
+# flipped sprites are surfaces of their own, so there is one mask per image, scale and flip combination.
+# The sprite is placed like the box, so the pivot of the renderer has to be the center of the sprite.
+class MaskCollider(BoxCollider):
+
+    pixel_perfect = True
+
+    # maps the sprite surfaces to their masks, a mask goes away along with its sprite
+    sprite_masks = weakref.WeakKeyDictionary()
+
+    # masks of whole boxes and circles by their size
+    shape_masks = dict()
+
+    def __init__(self, width=0.0, height=0.0):
+        super(MaskCollider, self).__init__(width, height)
+
+    def get_pixel_mask(self):
+        sprite = self.entity.renderer.sprite
+
+        mask = MaskCollider.sprite_masks.get(sprite)
+        if mask is None:
+            mask = MaskCollider.sprite_masks[sprite] = from_surface(sprite)
+
+        return mask
+
+    # The mask of a collider. Colliders that are not pixel perfect use the mask of their whole shape.
+    @staticmethod
+    def get_shape_mask(collider):
+
+        if collider.pixel_perfect:
+            return collider.get_pixel_mask()
+
+        if collider.tag == CircleCollider.tag:
+            key = ("circle", int(collider.radius))
+        else:
+            key = ("box", collider.box.width, collider.box.height)
+
+        mask = MaskCollider.shape_masks.get(key)
+
+        if mask is None:
+
+            if key[0] == "circle":
+                r = key[1]
+                surface = Surface((2 * r, 2 * r), SRCALPHA)
+                draw.circle(surface, (255, 255, 255), (r, r), r)
+                mask = from_surface(surface)
+
+            else:
+                mask = Mask((key[1], key[2]))
+                mask.fill()
+
+            MaskCollider.shape_masks[key] = mask
+
+        return mask
+
 
 class CircleCollider(Collider):
     tag = "circle collider"
@@ -217,6 +423,153 @@ class CircleCollider(Collider):
         super(CircleCollider, self).__init__()
         self.radius = radius
 
+    def compute_bounds(self):
+        position = self.entity.transform.position
+        r = self.radius
+        return position.x - r, position.y - r, position.x + r, position.y + r
+
+
+# A convex polygon that turns along with the rotation of the transform, in degrees counter-clockwise like
+# pygame.transform.rotate. The vertices are (x, y) tuples relative to the transform position, in order
+# around the polygon, and are scaled by the scale of the transform. The world space vertices and the normals
+# of the edges are cached along with the versions of the transform and the collider they were computed for,
+# so they are only recomputed when the transform moves, turns or scales, or when the vertices change.
+class PolygonCollider(Collider):
+    tag = "polygon collider"
+
+    def __init__(self, vertices=()):
+        super(PolygonCollider, self).__init__()
+        self.vertices = list(vertices)
+
+        self._world_vertices = None
+        self._normals = None
+        self._shape_versions = None
+
+    def set_vertices(self, vertices):
+        self.vertices = list(vertices)
+        self.mark_changed()
+
+    def get_world_vertices(self):
+        self._update_shape()
+        return self._world_vertices
+
+    # The unit normals of the edges of the polygon in world space
+    def get_normals(self):
+        self._update_shape()
+        return self._normals
+
+    def _update_shape(self):
+        transform = self.entity.transform
+        versions = (transform.version, self.version)
+
+        if versions == self._shape_versions:
+            return
+
+        angle = radians(transform.degrees)
+        c = cos(angle)
+        s = sin(angle)
+
+        x_scale = transform.scale.x
+        y_scale = transform.scale.y
+        x_origin = transform.position.x
+        y_origin = transform.position.y
+
+        world_vertices = list()
+        for x, y in self.vertices:
+            x = x * x_scale + self.offset.x
+            y = y * y_scale + self.offset.y
+            world_vertices.append((x_origin + x * c + y * s, y_origin - x * s + y * c))
+
+        normals = list()
+        count = len(world_vertices)
+        for i in range(0, count):
+            x_start, y_start = world_vertices[i]
+            x_end, y_end = world_vertices[(i + 1) % count]
+
+            # the perpendicular of the edge
+            nx = y_end - y_start
+            ny = x_start - x_end
+
+            length = sqrt(nx * nx + ny * ny)
+            if length > 0:
+                normals.append((nx / length, ny / length))
+
+        self._world_vertices = world_vertices
+        self._normals = normals
+        self._shape_versions = versions
+
+    def compute_bounds(self):
+        world_vertices = self.get_world_vertices()
+
+        if not world_vertices:
+            return super(PolygonCollider, self).compute_bounds()
+
+        xs = [v[0] for v in world_vertices]
+        ys = [v[1] for v in world_vertices]
+        return min(xs), min(ys), max(xs), max(ys)
+
+
+# A grid of solid tiles that collides like a static box collider per tile, without an entity per tile.
+# The tiles are kept in a bytearray with one byte per tile, zero for empty, so a level of 100k tiles takes
+# 100k bytes. The map is indexed as a single static collider and the bodies that overlap it are only tested
+# against the tiles under their bounds, looked up by cell. The transform position is the top left corner.
+class TileCollisionMap(Collider):
+    tag = "tile collision map"
+
+    def __init__(self, columns, rows, tile_width, tile_height):
+        super(TileCollisionMap, self).__init__()
+
+        self.columns = columns
+        self.rows = rows
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+
+        # row major tiles
+        self.tiles = bytearray(columns * rows)
+
+    def set_tile(self, column, row, value=1):
+        self.tiles[row * self.columns + column] = value
+
+    # Tiles outside of the map are empty
+    def get_tile(self, column, row):
+        if 0 <= column < self.columns and 0 <= row < self.rows:
+            return self.tiles[row * self.columns + column]
+        return 0
+
+    # Set the tiles from a list of strings, one per row, where the solid character is a solid tile
+    def set_rows(self, rows, solid="#"):
+        for row in range(0, min(len(rows), self.rows)):
+            line = rows[row]
+            for column in range(0, min(len(line), self.columns)):
+                self.set_tile(column, row, 1 if line[column] == solid else 0)
+
+    # The top left corner of the map in world space
+    def get_origin(self):
+        position = self.entity.transform.position
+        return position.x + self.offset.x, position.y + self.offset.y
+
+    # The (first column, first row, last column, last row) of the cells that the bounds cover,
+    # clamped to the map. The first ones are larger than the last ones if the bounds miss the map.
+    def get_cell_range(self, bounds):
+        x, y = self.get_origin()
+
+        first_column = max(0, int(floor((bounds[0] - x) / self.tile_width)))
+        first_row = max(0, int(floor((bounds[1] - y) / self.tile_height)))
+        last_column = min(self.columns - 1, int(floor((bounds[2] - x) / self.tile_width)))
+        last_row = min(self.rows - 1, int(floor((bounds[3] - y) / self.tile_height)))
+
+        return first_column, first_row, last_column, last_row
+
+    def get_tile_bounds(self, column, row):
+        x, y = self.get_origin()
+        left = x + column * self.tile_width
+        top = y + row * self.tile_height
+        return left, top, left + self.tile_width, top + self.tile_height
+
+    def compute_bounds(self):
+        x, y = self.get_origin()
+        return x, y, x + self.columns * self.tile_width, y + self.rows * self.tile_height
+
 
 class Animator(Component):
 
@@ -250,7 +603,7 @@ class Animator(Component):
         super(Animator, self).__init__()
         self.current_animation = None
 
-        # track how much time has passed
+        # track how much time has passed, in whole ticks in the deterministic mode of the engine
         self.latency_accumulator = 0.0
 
         # the current frame from the animation
@@ -273,7 +626,8 @@ class Animator(Component):
         # the current animation, and also scale it to the current transform's scale
         self.entity.renderer.original_image = Renderer.scale_image(self.current_animation.frames[0], x_scale, y_scale)
 
-    def _update_animation(self):
+    # Advance the animation by the elapsed time: seconds, or ticks in the deterministic mode of the engine
+    def _update_animation(self, elapsed):
 
         anim = self.current_animation
 
@@ -283,29 +637,49 @@ class Animator(Component):
 
             if num_of_frames > 0:
 
-                # time to go to the next frame
-                if self.latency_accumulator > anim.frame_latency:
+                engine = self.entity.world.engine
+
+                if engine.deterministic:
 
-                    self.current_frame_index += 1
+                    # the latency in whole ticks, at most one frame per tick
+                    latency = max(int(round(anim.frame_latency * engine.ticks_per_second)), 1)
 
-                    # cycle through frames
-                    if anim.cycle:
-                        self.current_frame_index %= num_of_frames
+                    self.latency_accumulator += elapsed
 
-                    # stop at the last frame
-                    elif self.current_frame_index >= len(anim.frames):
-                        return
+                    # keep the ticks past the latency so the frames land on the same ticks
+                    if self.latency_accumulator >= latency:
+                        self.latency_accumulator -= latency
+                        self._next_frame()
 
-                    # Update the renderer's image to display
-                    index = self.current_frame_index
-                    self.entity.renderer.sprite = anim.frames[index]
+                else:
 
-                    # reset accumulator
-                    self.latency_accumulator = 0.0
+                    # time to go to the next frame
+                    if self.latency_accumulator > anim.frame_latency:
 
-                # increment accumulator
-                dt = self.entity.world.engine.delta_time
-                self.latency_accumulator += dt
+                        # reset accumulator
+                        self.latency_accumulator = 0.0
+                        self._next_frame()
+
+                    # increment accumulator
+                    self.latency_accumulator += elapsed
+
+    def _next_frame(self):
+
+        anim = self.current_animation
+
+        self.current_frame_index += 1
+
+        # cycle through frames
+        if anim.cycle:
+            self.current_frame_index %= len(anim.frames)
+
+        # stop at the last frame
+        elif self.current_frame_index >= len(anim.frames):
+            return
+
+        # Update the renderer's image to display
+        index = self.current_frame_index
+        self.entity.renderer.sprite = anim.frames[index]
 
 
 # This component simply flags which entity can receive input.
@@ -354,10 +728,21 @@ class BehaviorScript(Script):
         self.entity = None
 
     # The physics system calls this function when the belonging
-    # entity of this script collides with another entity's collider
+    # entity of this script collides with another entity's collider.
+    # It is called at every frame that the colliders are touching.
     def collision_event(self, other_collider):
         pass
 
+    # This is called by the Physics system at the end of the first frame
+    # that the entity collides with the other collider
+    def collision_enter_event(self, other_collider):
+        pass
+
+    # This is called by the Physics system at the end of every following frame
+    # that the entity keeps colliding with the other collider
+    def collision_stay_event(self, other_collider):
+        pass
+
     # This is called by the Physics system when the entity stops colliding with the other
     # collider
     def collision_exit_event(self, other_collider):
@@ -0,0 +1,247 @@
+from broadphase import Broadphase
+
+
+# Keeps the pairs of colliders to test during a frame and the contacts found between them.
+# Every unordered pair is kept once, so the pair is tested and resolved once and each
+# of the two entities gets one collision event for it.
+#
+# The contacts persist from one frame to the next in a table keyed by the uuids of the pair.
+# Comparing the table to the one of the last frame tells which contacts started (enter),
+# continued (stay) or ended (exit) without comparing every contact to every other one.
+class ContactManager(object):
+
+    def __init__(self):
+
+        # Maps the uuid of a dynamic entity to the pairs that are tested on its turn
+        self.pairs = dict()
+
+        # Maps the uuid of a continuous or sub-stepped body to the entities it may hit this frame
+        self.candidates = dict()
+
+        # The unique (entity A, entity B) pairs that collided this frame
+        self.contacts = list()
+
+        # Map the uuid key of each contact to its pair, for this frame and the last one
+        self.table = dict()
+        self.previous_table = dict()
+
+        # Map the uuid of each entity to the keys of its contacts in the table and in the previous table,
+        # so the contacts of one entity are found without going through every contact
+        self.keys = dict()
+        self.previous_keys = dict()
+
+    # Start a new frame. The contacts of the frame that ended become the previous contacts.
+    def clear(self):
+        self.pairs.clear()
+        self.candidates.clear()
+        del self.contacts[:]
+
+        self.previous_table = self.table
+        self.table = dict()
+
+        self.previous_keys = self.keys
+        self.keys = dict()
+
+    # the key of an unordered pair
+    @staticmethod
+    def get_key(eA, eB):
+        if eA.uuid < eB.uuid:
+            return eA.uuid, eB.uuid
+        return eB.uuid, eA.uuid
+
+    # Group the candidate pairs by the dynamic entity whose turn tests them. The physics system
+    # moves the entities one by one in the order of the moving list, so a pair of dynamic
+    # entities is tested on the turn of whichever comes last, once both of them have moved.
+    # The substepped set holds the uuids of the bodies that are moved in sub-steps.
+    def add_pairs(self, moving, pairs, substepped=()):
+
+        order = dict()
+        for i in range(0, len(moving)):
+            order[moving[i].uuid] = i
+
+        for eA, eB in pairs:
+
+            # entities missing from the moving list (static or asleep) never have a turn
+            turn_a = order.get(eA.uuid, -1) if Broadphase.is_dynamic(eA) else -1
+            turn_b = order.get(eB.uuid, -1) if Broadphase.is_dynamic(eB) else -1
+
+            if turn_a < 0 and turn_b < 0:
+                continue
+
+            owner = eA if turn_a > turn_b else eB
+            self.pairs.setdefault(owner.uuid, []).append((eA, eB))
+
+            for e, other in ((eA, eB), (eB, eA)):
+                if e.rigid_body is not None and (e.rigid_body.continuous or e.uuid in substepped):
+                    self.candidates.setdefault(e.uuid, []).append(other)
+
+        # The broadphases report the pairs in different orders. Test them in the order of their keys
+        # so that the results, which depend on the order the pairs are resolved in, do not.
+        for owner_pairs in self.pairs.values():
+            owner_pairs.sort(key=ContactManager._get_pair_key)
+
+        for others in self.candidates.values():
+            others.sort(key=ContactManager._get_uuid)
+
+    @staticmethod
+    def _get_pair_key(pair):
+        return ContactManager.get_key(pair[0], pair[1])
+
+    @staticmethod
+    def _get_uuid(entity):
+        return entity.uuid
+
+    # The pairs tested on the turn of the entity
+    def get_pairs(self, entity):
+        return self.pairs.get(entity.uuid, ())
+
+    # The entities a continuous or sub-stepped body may hit this frame
+    def get_candidates(self, entity):
+        return self.candidates.get(entity.uuid, ())
+
+    # Every pair to test this frame
+    def get_all_pairs(self):
+        all_pairs = list()
+        for pairs in self.pairs.values():
+            all_pairs.extend(pairs)
+        return all_pairs
+
+    # The entities in contact with the entity in this frame or the last one, which
+    # includes the contacts that are kept for the sleeping bodies
+    def get_touching(self, entity):
+
+        touching = list()
+
+        for table, keys in ((self.table, self.keys), (self.previous_table, self.previous_keys)):
+            for key in keys.get(entity.uuid, ()):
+                other = ContactManager._get_other(table[key], entity)
+                if other is not None:
+                    touching.append(other)
+
+        return touching
+
+    # Forget the contacts of an entity that is removed from the world. The entities it was in contact
+    # with since the last frame get their exit event, the contacts that started in this frame end
+    # before their enter event is called. Returns the entities it was in contact with.
+    def remove_entity(self, entity):
+
+        touching = list()
+        exited = list()
+
+        for table, keys in ((self.table, self.keys), (self.previous_table, self.previous_keys)):
+
+            # ids are recycled, so the keys of the uuid may belong to the contacts of an older entity
+            for key in list(keys.get(entity.uuid, ())):
+
+                other = ContactManager._get_other(table[key], entity)
+                if other is None:
+                    continue
+
+                touching.append(other)
+
+                if table is self.previous_table and other not in exited:
+                    exited.append(other)
+
+                del table[key]
+                ContactManager._unindex_key(keys, entity, key)
+                ContactManager._unindex_key(keys, other, key)
+
+        for other in exited:
+            for s in other.scripts:
+                s.collision_exit_event(entity.collider)
+
+        return touching
+
+    # the other entity of the pair, or None if the entity is not in the pair
+    @staticmethod
+    def _get_other(pair, entity):
+        if pair[0] is entity:
+            return pair[1]
+        if pair[1] is entity:
+            return pair[0]
+        return None
+
+    @staticmethod
+    def _index_key(keys, pair, key):
+        for e in pair:
+            keys.setdefault(e.uuid, set()).add(key)
+
+    @staticmethod
+    def _unindex_key(keys, entity, key):
+        entity_keys = keys.get(entity.uuid)
+        if entity_keys is not None:
+            entity_keys.discard(key)
+            if not entity_keys:
+                del keys[entity.uuid]
+
+    # Record a collision between the entities and call the collision event inside their scripts
+    def add_contact(self, eA, eB):
+
+        key = ContactManager.get_key(eA, eB)
+        if key in self.table:
+            return
+
+        pair = (eA, eB)
+        self.table[key] = pair
+        self.contacts.append(pair)
+        ContactManager._index_key(self.keys, pair, key)
+
+        for s in eA.scripts:
+            s.collision_event(eB.collider)
+
+        for s in eB.scripts:
+            s.collision_event(eA.collider)
+
+        # the scripts may have moved the entities
+        eA.transform.check_changed()
+        eB.transform.check_changed()
+
+    # Call the collision enter, stay and exit events inside the scripts of the entities.
+    # Contacts of sleeping bodies are not tested, so a contact of the last frame with
+    # a body for which is_asleep(entity) is True is kept without calling any event.
+    def fire_events(self, is_asleep):
+
+        table = self.table
+        previous_table = self.previous_table
+
+        for pair in self.contacts:
+
+            key = ContactManager.get_key(*pair)
+
+            # the contact ended when one of the entities was removed from the world
+            if table.get(key) is not pair:
+                continue
+
+            eA, eB = pair
+
+            if key in previous_table:
+                for s in eA.scripts:
+                    s.collision_stay_event(eB.collider)
+
+                for s in eB.scripts:
+                    s.collision_stay_event(eA.collider)
+
+            else:
+                for s in eA.scripts:
+                    s.collision_enter_event(eB.collider)
+
+                for s in eB.scripts:
+                    s.collision_enter_event(eA.collider)
+
+        for key, pair in previous_table.items():
+
+            if key in table:
+                continue
+
+            eA, eB = pair
+
+            if is_asleep(eA) or is_asleep(eB):
+                table[key] = pair
+                ContactManager._index_key(self.keys, pair, key)
+                continue
+
+            for s in eA.scripts:
+                s.collision_exit_event(eB.collider)
+
+            for s in eB.scripts:
+                s.collision_exit_event(eA.collider)
@@ -10,6 +10,9 @@ from random import uniform
 
 engine = Engine(1200, 700)
 
+# collision layer of the bullets, bullets do not collide with each other
+bullet_layer = 1
+
 
 class TargetBehavior(BehaviorScript):
 
@@ -70,6 +73,10 @@ class Shoot(BehaviorScript):
 
     def update(self):
 
+        # aim at the closest target
+        if self.target is None:
+            self.target = self.entity.world.nearest(self.entity.transform.position, tag="target")
+
         if self.target is None:
             return
 
@@ -90,6 +97,7 @@ class Shoot(BehaviorScript):
         pos = self.entity.transform.position
         bullet.transform.position = Vector2(pos.x, pos.y)
         bullet.collider.is_trigger = True
+        bullet.collider.set_layer(bullet_layer)
         return bullet
 
     def fire(self):
@@ -156,12 +164,15 @@ class ShootingRange(World):
         back = self.create_renderable_object(back_img, Vector2(0, 0))
         back.renderer.depth = 100
 
+        self.set_layer_collision(bullet_layer, bullet_layer, False)
+
         # setup target
         orange = RenderSystem.create_solid_image(20, 20, (255, 100, 0))
         target = self.create_game_object(orange)
         target.add_component(RigidBody(Vector2(100, 0)))
         target.transform.position = Vector2(100, 100)
         target.collider.is_trigger = True
+        target.tag = "target"
 
         target.add_script(TargetBehavior("target behavior"))
 
@@ -170,9 +181,7 @@ class ShootingRange(World):
         turret = self.create_renderable_object(red)
         turret.transform.position = Vector2(size[0] / 2, size[1] / 2)
 
-        shoot_script = Shoot("shoot")
-        shoot_script.target = target
-        turret.add_script(shoot_script)
+        turret.add_script(Shoot("shoot"))
 
 
 s = ShootingRange()
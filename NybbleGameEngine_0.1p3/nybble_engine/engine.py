@@ -17,6 +17,7 @@ from pygame import font
 from util_math import Vector2
 from managers import IdManager
 from systems import RenderSystem
+from systems import PhysicsSystem
 
 # Engine processes the current world, reads input events
 # and handles the main game loop
@@ -47,6 +48,35 @@ class Engine:
         self.debug = False
         self.paused = False
 
+        # Longest delta time the world is run with, so a slow frame does not make objects jump
+        self.max_delta_time = 0.05
+
+        # In fixed timestep mode the physics and scripts always advance by fixed_delta_time, as many
+        # times as the elapsed time allows, and rendering interpolates between the last two steps.
+        # This keeps the simulation cost independent of the frame rate.
+        self.fixed_timestep = False
+        self.fixed_delta_time = 1.0 / 60
+
+        # Most steps to run in a single frame. If the steps take longer than the time they simulate
+        # the remaining time is dropped instead of falling further behind every frame.
+        self.max_steps_per_frame = 5
+
+        # time that has not been simulated yet
+        self.accumulator = 0.0
+
+        # In deterministic mode the world is stepped in ticks of exactly 1 / ticks_per_second seconds.
+        # The elapsed time is accumulated in integer milliseconds, the physics state is kept in fixed point
+        # and animations advance by whole ticks, so the same inputs give the same state on every run.
+        # Implies the fixed timestep mode. Compare runs with World.get_state_hash().
+        self.deterministic = False
+        self.ticks_per_second = 60
+
+        # the number of ticks stepped so far
+        self.tick = 0
+
+        # milliseconds that have not been simulated yet, multiplied by the ticks per second
+        self.tick_accumulator = 0
+
         self.print_fps = False
 
         self.worlds = list()
@@ -58,13 +88,17 @@ class Engine:
         self.world = world
         self.world.resume()
 
+        # the screen still shows the last world
+        render_system = world.get_system(RenderSystem.tag)
+        if render_system is not None:
+            render_system.redraw()
+
         if append:
             self.worlds.append(world)
 
     def run(self):
 
         timer = pygame.time.Clock()
-        last_frame_time = 0.0
 
         for world in self.worlds:
 
@@ -83,19 +117,21 @@ class Engine:
             # construct the scene order from the initial entities
             render_system.construct_scene(world.entity_manager.entities)
 
-        while True:
+        last_frame_time = pygame.time.get_ticks()
 
-            # do not run the game if delta time is too high
-            if self.delta_time >= 0.05:
-                self.delta_time = 0.0
-                continue
+        # time that elapsed during the last frame
+        elapsed_time = 0.0
+        elapsed_ms = 0
 
-            # Get the initial time in milliseconds of the current frame
-            frame_start_time = pygame.time.get_ticks()
+        while True:
 
             if self.print_fps:
                 print("FPS: ", timer.get_fps(), "delta time: ", self.delta_time)
 
+                physics_system = self.world.get_system(PhysicsSystem.tag)
+                if physics_system is not None:
+                    print("Candidate collision pairs: ", physics_system.candidate_pairs)
+
             if self.world is None:
                 print("Error, the world specified is None.")
                 Engine.clean_up()
@@ -133,19 +169,85 @@ class Engine:
 
             # Run the currently set world
             if not self.paused:
-                self.world.run()
+                if self.deterministic:
+                    self._run_ticks(elapsed_ms)
+                elif self.fixed_timestep:
+                    self._run_fixed_steps(elapsed_time)
+                else:
+                    self.world.run()
 
             # draw gui elements on top of everything
             self.gui.draw_widgets()
 
-            pygame.display.update()
+            # only update the parts of the display that the render system redrew
+            render_system = self.world.get_system(RenderSystem.tag)
+            if self.paused or render_system is None or render_system.updated_rects is None:
+                pygame.display.update()
+            else:
+                pygame.display.update(render_system.updated_rects)
 
-            # The time interval between this frame and the last one.
-            # Convert the time from milliseconds to seconds
-            self.delta_time = (frame_start_time - last_frame_time)/1000.0
-            last_frame_time = frame_start_time
             timer.tick(self.fps)
 
+            # The time interval between this frame and the next one.
+            # Convert the time from milliseconds to seconds
+            frame_end_time = pygame.time.get_ticks()
+            elapsed_ms = frame_end_time - last_frame_time
+            elapsed_time = elapsed_ms/1000.0
+            last_frame_time = frame_end_time
+
+            self.delta_time = min(elapsed_time, self.max_delta_time)
+
+    # Simulate the elapsed time in fixed steps then render the world in between the last two steps
+    def _run_fixed_steps(self, elapsed_time):
+
+        fixed_delta_time = self.fixed_delta_time
+
+        self.accumulator += elapsed_time
+
+        # the systems and scripts see the fixed delta time while stepping
+        self.delta_time = fixed_delta_time
+
+        steps = 0
+        while self.accumulator >= fixed_delta_time and steps < self.max_steps_per_frame:
+            self.world.step()
+            self.accumulator -= fixed_delta_time
+            steps += 1
+
+        # drop the time the steps could not keep up with
+        if self.accumulator >= fixed_delta_time:
+            self.accumulator %= fixed_delta_time
+
+        # animations advance with the real frame time
+        self.delta_time = min(elapsed_time, self.max_delta_time)
+
+        self.world.render(self.accumulator / fixed_delta_time)
+
+    # Simulate the elapsed milliseconds in whole ticks then render the world in between the last two ticks.
+    # Only integers are accumulated so the number of ticks does not depend on rounding errors.
+    def _run_ticks(self, elapsed_ms):
+
+        # a tick is worth 1000 of the accumulated units
+        self.tick_accumulator += elapsed_ms * self.ticks_per_second
+
+        steps = 0
+        while self.tick_accumulator >= 1000 and steps < self.max_steps_per_frame:
+            self.step_tick()
+            self.tick_accumulator -= 1000
+            steps += 1
+
+        # drop the time the ticks could not keep up with
+        if self.tick_accumulator >= 1000:
+            self.tick_accumulator %= 1000
+
+        self.world.render(self.tick_accumulator / 1000.0)
+
+    # Advance the world by one tick. Replays and lockstep games can call it directly
+    # with the inputs of each tick instead of running the real time game loop.
+    def step_tick(self):
+        self.delta_time = 1.0 / self.ticks_per_second
+        self.world.step()
+        self.tick += 1
+
     @staticmethod
     def clean_up():
         font.quit()
@@ -50,6 +50,9 @@ class Entity (object):
 
         self.components.append(component)
 
+        if self.world is not None:
+            self.world._colliders_changed(self)
+
     def remove_component(self, component_tag):
         i = 0
         for c in self.components:
@@ -71,6 +74,9 @@ class Entity (object):
                 elif component_tag == Animator.tag:
                     self.animator = None
 
+                if self.world is not None:
+                    self.world._colliders_changed(self)
+
                 return
             i += 1
 
@@ -80,6 +86,9 @@ class Entity (object):
         script.entity = self
         self.scripts.append(script)
 
+        if self.world is not None:
+            self.world._colliders_changed(self)
+
     def remove_script(self, script_name):
         i = 0
         for s in self.scripts:
@@ -87,6 +96,10 @@ class Entity (object):
             # script found
             if s.script_name == script_name:
                 self.scripts.pop(i)
+
+                if self.world is not None:
+                    self.world._colliders_changed(self)
+
                 return
             i += 1
 
@@ -156,6 +169,26 @@ class RenderableObject (Entity):
         self.add_component(self.renderer)
 
 
+# A game object whose collider only collides where its image is opaque.
+# The image is centered for the render component.
+class MaskColliderObject (Entity):
+    def __init__(self, image_surface, uuid=0):
+        super(MaskColliderObject, self).__init__(uuid)
+
+        img_width = image_surface.get_width()
+        img_height = image_surface.get_height()
+
+        pivot = Vector2(img_width/2, img_height/2)
+
+        self.transform = Transform(Vector2(0, 0))
+        self.renderer = Renderer(image_surface, pivot)
+        self.collider = components.MaskCollider(img_width, img_height)
+
+        self.add_component(self.transform)
+        self.add_component(self.renderer)
+        self.add_component(self.collider)
+
+
 # A game object with only a transform and collision box components.
 # Could be used to create invisible game barriers
 class BoxColliderObject (Entity):
@@ -169,6 +202,19 @@ class BoxColliderObject (Entity):
         self.add_component(self.collider)
 
 
+# A transform and a tile collision map. The position is the top left corner of the map.
+class TileMapObject(Entity):
+
+    def __init__(self, columns, rows, tile_width, tile_height, uuid=0):
+        super(TileMapObject, self).__init__(uuid)
+
+        self.transform = Transform(Vector2(0, 0))
+        self.collider = components.TileCollisionMap(columns, rows, tile_width, tile_height)
+
+        self.add_component(self.transform)
+        self.add_component(self.collider)
+
+
 class CircleColliderObject(Entity):
 
     def __init__(self, radius, uuid=0):
@@ -178,4 +224,16 @@ class CircleColliderObject(Entity):
         self.collider = components.CircleCollider(radius)
 
         self.add_component(self.transform)
-        self.add_component(self.collider)
\ No newline at end of file
+        self.add_component(self.collider)
+
+
+class PolygonColliderObject(Entity):
+
+    def __init__(self, vertices, uuid=0):
+        super(PolygonColliderObject, self).__init__(uuid)
+
+        self.transform = Transform(Vector2(0, 0))
+        self.collider = components.PolygonCollider(vertices)
+
+        self.add_component(self.transform)
+        self.add_component(self.collider)
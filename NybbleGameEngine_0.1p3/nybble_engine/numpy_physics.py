@@ -0,0 +1,586 @@
+# Optional physics backends built on NumPy. This module requires numpy
+# and is only imported by games that opt in to it:
+#
+#   from numpy_physics import NumpyIntegrator, BatchNarrowphase, ParallelBroadphase
+#   world.get_system(PhysicsSystem.tag).integrator = NumpyIntegrator()
+#   world.get_system(PhysicsSystem.tag).batch_narrowphase = BatchNarrowphase()
+#   world.get_system(PhysicsSystem.tag).broadphase = ParallelBroadphase()
+
+import multiprocessing
+
+import numpy
+
+from broadphase import Broadphase
+from components import BoxCollider, CircleCollider
+from systems import PhysicsSystem
+
+
+# Stores the positions, velocities and gravity scales of the rigid bodies in contiguous arrays
+# (structure of arrays) and integrates all of the bodies with one vectorized step per frame.
+# Each body keeps the same slot of the arrays for as long as it is integrated, and the arrays
+# hold its state between the frames. The Transform positions and RigidBody velocities stay
+# ordinary Vector2s so scripts and the collision response keep working, so only what changed
+# is synced: a position is read back when the version of its transform changed, a velocity or
+# gravity scale when it differs from the array, and only the moved bodies are written to.
+#
+# Unlike the default integration which moves a body right before its collisions are tested,
+# every body is moved before any collision is resolved.
+class NumpyIntegrator(object):
+
+    def __init__(self):
+
+        # Maps the uuids of the entities to their slots and the slots to their entities.
+        # A slot of None is free.
+        self.slots = dict()
+        self.entities = list()
+        self.free_slots = list()
+
+        self.positions = numpy.zeros((0, 2))
+        self.velocities = numpy.zeros((0, 2))
+        self.gravity_scales = numpy.zeros(0)
+
+        # the version of the transform of each slot when its position was last synced
+        self.versions = numpy.zeros(0, dtype=numpy.int64)
+
+        # the last step that integrated each slot
+        self.stamps = numpy.zeros(0, dtype=numpy.int64)
+        self.stamp = 0
+
+        # the ids of the entities of the last step and their slots, reused while the entities stay the same
+        self._last_ids = None
+        self._last_slots = None
+
+    # Move the rigid bodies of the entities by their velocities and apply gravity to them
+    def integrate(self, entities, dt, gravity, terminal_speed):
+
+        self.stamp += 1
+
+        n = len(entities)
+        if n == 0:
+            self._free_stale_slots()
+            return
+
+        slots = self._get_slots(entities)
+        self._free_stale_slots()
+
+        transforms = [e.transform for e in entities]
+        rigid_bodies = [e.rigid_body for e in entities]
+
+        self._sync_in(transforms, rigid_bodies, slots)
+
+        positions = self.positions[slots]
+        velocities = self.velocities[slots]
+        gravity_scales = self.gravity_scales[slots]
+
+        moved = numpy.flatnonzero(velocities.any(axis=1))
+        positions += dt * velocities
+
+        # limit acceleration due to terminal velocity
+        below_terminal = (velocities * velocities).sum(axis=1) < terminal_speed * terminal_speed
+        accelerated = numpy.flatnonzero(below_terminal & (gravity_scales != 0))
+
+        velocities[accelerated] += numpy.outer(dt * gravity_scales[accelerated], (gravity.x, gravity.y))
+
+        self.positions[slots] = positions
+        self.velocities[slots] = velocities
+
+        self._sync_out(transforms, rigid_bodies, slots, moved, accelerated)
+
+    # The slot of each entity, giving a slot to the entities that do not have one yet
+    def _get_slots(self, entities):
+
+        ids = list(map(id, entities))
+        if ids == self._last_ids:
+            self.stamps[self._last_slots] = self.stamp
+            return self._last_slots
+
+        slots = self.slots
+        owners = self.entities
+
+        result = list()
+        for e in entities:
+            slot = slots.get(e.uuid)
+
+            # ids are recycled, so a new entity may own the uuid of a removed one
+            if slot is None or owners[slot] is not e:
+                slot = self._add_entity(e)
+
+            result.append(slot)
+
+        result = numpy.array(result, dtype=numpy.intp)
+        self.stamps[result] = self.stamp
+
+        self._last_ids = ids
+        self._last_slots = result
+        return result
+
+    def _add_entity(self, entity):
+
+        old_slot = self.slots.get(entity.uuid)
+        if old_slot is not None:
+            self._remove_slot(old_slot)
+
+        if not self.free_slots:
+            self._grow()
+
+        slot = self.free_slots.pop()
+        self.slots[entity.uuid] = slot
+        self.entities[slot] = entity
+
+        position = entity.transform.position
+        velocity = entity.rigid_body.velocity
+
+        self.positions[slot] = (position.x, position.y)
+        self.velocities[slot] = (velocity.x, velocity.y)
+        self.gravity_scales[slot] = entity.rigid_body.gravity_scale
+        self.versions[slot] = entity.transform.version
+
+        return slot
+
+    def _remove_slot(self, slot):
+        entity = self.entities[slot]
+
+        if self.slots.get(entity.uuid) == slot:
+            del self.slots[entity.uuid]
+
+        self.entities[slot] = None
+        self.free_slots.append(slot)
+        self._last_ids = None
+
+    # Free the slots of the bodies that were not integrated in this step, such
+    # as the ones that were destroyed, fell asleep or became continuous
+    def _free_stale_slots(self):
+
+        if len(self.slots) == 0:
+            return
+
+        stale = numpy.flatnonzero(self.stamps != self.stamp).tolist()
+        for slot in stale:
+            if self.entities[slot] is not None:
+                self._remove_slot(slot)
+
+    # double the capacity of the arrays to avoid reallocating every time a body is added
+    def _grow(self):
+
+        size = len(self.entities)
+        capacity = max(16, 2 * size)
+
+        self.positions = numpy.resize(self.positions, (capacity, 2))
+        self.velocities = numpy.resize(self.velocities, (capacity, 2))
+        self.gravity_scales = numpy.resize(self.gravity_scales, capacity)
+        self.versions = numpy.resize(self.versions, capacity)
+
+        # the new slots are stale until they are used
+        stamps = numpy.zeros(capacity, dtype=numpy.int64)
+        stamps[:size] = self.stamps
+        self.stamps = stamps
+
+        self.entities.extend([None] * (capacity - size))
+        self.free_slots.extend(range(capacity - 1, size - 1, -1))
+
+    # Copy the positions of the transforms whose versions changed and the velocities
+    # and gravity scales that scripts or the collision response changed into the arrays
+    def _sync_in(self, transforms, rigid_bodies, slots):
+
+        versions = numpy.array([t.version for t in transforms], dtype=numpy.int64)
+
+        for i in numpy.flatnonzero(versions != self.versions[slots]).tolist():
+            position = transforms[i].position
+            self.positions[slots[i]] = (position.x, position.y)
+
+        self.versions[slots] = versions
+
+        # the velocity and gravity scale of each body in one pass over the bodies
+        states = numpy.array([(r.velocity.x, r.velocity.y, r.gravity_scale) for r in rigid_bodies], dtype=float)
+        velocities = states[:, :2]
+        gravity_scales = states[:, 2]
+
+        stored = self.velocities[slots]
+        changed = numpy.flatnonzero((velocities != stored).any(axis=1) |
+                                    (gravity_scales != self.gravity_scales[slots]))
+
+        if len(changed):
+            changed_slots = slots[changed]
+            self.velocities[changed_slots] = velocities[changed]
+            self.gravity_scales[changed_slots] = gravity_scales[changed]
+
+    # Copy the positions of the bodies that moved and the velocities that gravity changed back to the bodies
+    def _sync_out(self, transforms, rigid_bodies, slots, moved, accelerated):
+
+        moved_slots = slots[moved]
+        positions = self.positions[moved_slots].tolist()
+
+        for transform, (x, y) in zip(map(transforms.__getitem__, moved.tolist()), positions):
+            position = transform.position
+            position.x = x
+            position.y = y
+
+            # bumps the version and remembers the state, so the move is not detected twice
+            transform.check_changed()
+
+        # the versions of the moved transforms went up by one
+        self.versions[moved_slots] += 1
+
+        velocities = self.velocities[slots[accelerated]].tolist()
+
+        for rigid_body, (x, y) in zip(map(rigid_bodies.__getitem__, accelerated.tolist()), velocities):
+            velocity = rigid_body.velocity
+            velocity.x = x
+            velocity.y = y
+
+
+# Tests the box to box and circle to circle candidate pairs of a frame in bulk. The shapes of the
+# entities are copied into arrays once, the pairs become index arrays into them and the overlap
+# tests, box hit orientations and penetration depths are computed with vectorized operations.
+# Only the pairs that are really in contact are handed back to the collision response.
+class BatchNarrowphase(object):
+
+    # the collider tags this narrowphase can test
+    tags = (BoxCollider.tag, CircleCollider.tag)
+
+    def __init__(self):
+
+        # The number of pairs tested and the contacts found in the last frame
+        self.tested_pairs = 0
+        self.contacts = 0
+
+    # Test the (A, B) pairs, where both colliders have the same tag. Returns a list of
+    # (entity A, entity B, orientation, depth) for the pairs that collide, in the order of the pairs.
+    # The orientation and depth are the side of box B that box A hit and how far A went into B.
+    # They are None for circles since their response works them out from the positions.
+    def find_contacts(self, pairs):
+
+        self.tested_pairs = len(pairs)
+
+        box_tag = BoxCollider.tag
+        box_pairs = [i for i in range(0, len(pairs)) if pairs[i][0].collider.tag == box_tag]
+        circle_pairs = [i for i in range(0, len(pairs)) if pairs[i][0].collider.tag != box_tag]
+
+        contacts = self._box_contacts(pairs, box_pairs) + self._circle_contacts(pairs, circle_pairs)
+
+        # keep the order of the pairs so the responses are applied like in the default narrowphase
+        contacts.sort(key=lambda contact: contact[0])
+
+        self.contacts = len(contacts)
+        return [contact[1:] for contact in contacts]
+
+    # Copy the shapes of the entities in the pairs into rows of an array. Returns the array and
+    # the row of A and B for each pair.
+    @staticmethod
+    def _gather(pairs, indices, shape):
+
+        rows = dict()
+        entities = list()
+
+        # the row of each entity, added the first time the entity is seen
+        def row(e):
+            r = rows.get(e.uuid)
+            if r is None:
+                r = rows[e.uuid] = len(entities)
+                entities.append(e)
+            return r
+
+        index_a = [row(pairs[i][0]) for i in indices]
+        index_b = [row(pairs[i][1]) for i in indices]
+
+        data = numpy.array([shape(e) for e in entities], dtype=float).reshape(len(entities), -1)
+
+        return data, numpy.array(index_a, dtype=int), numpy.array(index_b, dtype=int)
+
+    @staticmethod
+    def _box_shape(e):
+        position = e.transform.position
+        collider = e.collider
+        return position.x, position.y, collider.box.width, collider.box.height, collider.offset.x, collider.offset.y
+
+    @staticmethod
+    def _circle_shape(e):
+        position = e.transform.position
+        return position.x, position.y, e.collider.radius
+
+    # Rects round their coordinates to the nearest integer, halves away from zero
+    @staticmethod
+    def _rect_coordinate(values):
+        return numpy.copysign(numpy.floor(numpy.abs(values) + 0.5), values)
+
+    def _box_contacts(self, pairs, indices):
+
+        if not indices:
+            return []
+
+        data, index_a, index_b = self._gather(pairs, indices, self._box_shape)
+
+        x, y, width, height, offset_x, offset_y = data.T
+
+        # the boxes placed relative to their transforms, see get_relative_rect_pos()
+        left = self._rect_coordinate(x - width / 2 + offset_x)
+        top = self._rect_coordinate(y - height / 2 + offset_y)
+        right = left + width
+        bottom = top + height
+
+        # same test as Rect.colliderect, boxes that only touch do not collide
+        hit = ((left[index_a] < right[index_b]) & (left[index_b] < right[index_a]) &
+               (top[index_a] < bottom[index_b]) & (top[index_b] < bottom[index_a]))
+
+        hit_pairs = numpy.nonzero(hit)[0]
+        a = index_a[hit_pairs]
+        b = index_b[hit_pairs]
+
+        # the Minkowski sum of the boxes, see PhysicsSystem.calc_box_hit_orientation()
+        wy = 0.5 * (width[a] + width[b]) * (y[a] - y[b])
+        hx = 0.5 * (height[a] + height[b]) * (x[b] - x[a])
+
+        orientation = numpy.where(wy > hx,
+                                  numpy.where(wy > -hx, PhysicsSystem.top, PhysicsSystem.left),
+                                  numpy.where(wy > -hx, PhysicsSystem.right, PhysicsSystem.bottom))
+
+        # the penetration depth along the side that was hit, see PhysicsSystem.calc_box_penetration()
+        depth = numpy.choose(orientation, [bottom[b] - top[a],
+                                           bottom[a] - top[b],
+                                           right[b] - left[a],
+                                           right[a] - left[b]])
+
+        contacts = list()
+        for k, o, d in zip(hit_pairs.tolist(), orientation.tolist(), depth.tolist()):
+            i = indices[k]
+            contacts.append((i, pairs[i][0], pairs[i][1], o, d))
+
+        return contacts
+
+    def _circle_contacts(self, pairs, indices):
+
+        if not indices:
+            return []
+
+        data, index_a, index_b = self._gather(pairs, indices, self._circle_shape)
+
+        x, y, radius = data.T
+
+        dx = x[index_b] - x[index_a]
+        dy = y[index_b] - y[index_a]
+        radii = radius[index_a] + radius[index_b]
+
+        hit = dx * dx + dy * dy < radii * radii
+
+        contacts = list()
+        for k in numpy.nonzero(hit)[0].tolist():
+            i = indices[k]
+            contacts.append((i, pairs[i][0], pairs[i][1], None, None))
+
+        return contacts
+
+
+# Finds the candidate pairs of very large worlds, such as offline simulations with tens of thousands
+# of colliders, in worker processes. The world is cut into vertical strips of equal width (see World.width)
+# and each worker sweeps the colliders that reach into one strip.
+#
+# The bounds of the colliders are copied once per frame into arrays in shared memory, so the workers
+# read them without any pickling and only send back the index pairs they found. A pair that overlaps
+# across the border of two strips is seen by both workers. Only the strip that holds the left edge of
+# the overlap keeps it, so merging the strips in the main process gives every pair once.
+# The merged pairs are sorted by entity order and filtered by collision layers, so they are
+# the same for any number of strips or processes.
+#
+# Only the pair finding runs in parallel. The integration, the narrowphase and the collision responses
+# still run one after the other in the main process since each response moves bodies that the next
+# pairs are tested with, so the regions are not stepped separately. Call close() to stop the workers.
+class ParallelBroadphase(Broadphase):
+
+    def __init__(self, processes=None, strips=None, min_colliders=5000):
+        super(ParallelBroadphase, self).__init__()
+
+        # The number of worker processes, None for one per CPU
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+
+        # The number of strips to cut the world into, None for one per process
+        self.strips = strips
+
+        # Below this many colliders the strips are swept in the main process, since
+        # sending them to the workers costs more than sweeping them.
+        self.min_colliders = min_colliders
+
+        # the indexed entities in array order
+        self.entities = list()
+
+        # The swept bounds as (left, top, right, bottom) rows and whether each entity is dynamic.
+        # These are views of the shared memory that the workers read from.
+        self.capacity = 0
+        self.bounds = numpy.zeros((0, 4))
+        self.dynamic = numpy.zeros(0, dtype=numpy.int8)
+
+        self._shared_bounds = None
+        self._shared_dynamic = None
+
+        self.pool = None
+
+    def update(self, entities):
+
+        self.entities = [e for e in entities if not e.disabled and e.collider is not None]
+
+        n = len(self.entities)
+        if n == 0:
+            return
+
+        # grow the shared arrays, doubling their capacity like the NumpyIntegrator
+        if n > self.capacity:
+            self._allocate(max(n, 2 * self.capacity))
+
+        self.bounds[:n] = [self.get_swept_bounds(e) for e in self.entities]
+        self.dynamic[:n] = [Broadphase.is_dynamic(e) for e in self.entities]
+
+    # Create the shared arrays. The workers keep the arrays they were started with,
+    # so they are stopped and started again on the next frame.
+    def _allocate(self, capacity):
+
+        self.close()
+
+        self.capacity = capacity
+
+        self._shared_bounds = multiprocessing.RawArray('d', 4 * capacity)
+        self._shared_dynamic = multiprocessing.RawArray('b', capacity)
+
+        self.bounds = numpy.frombuffer(self._shared_bounds, dtype=float).reshape(capacity, 4)
+        self.dynamic = numpy.frombuffer(self._shared_dynamic, dtype=numpy.int8)
+
+    # Stop the worker processes. They are asked to exit rather than terminated, since
+    # the signal handlers that pygame installs keep them from being terminated.
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def get_pairs(self):
+
+        n = len(self.entities)
+        if n == 0:
+            return []
+
+        strips = self._get_strip_edges()
+
+        if self.processes > 1 and n >= self.min_colliders:
+
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes, _init_strip_worker,
+                                                 (self._shared_bounds, self._shared_dynamic, self.capacity))
+
+            found = self.pool.map(_sweep_shared_strip, [(n, left, right) for left, right in strips])
+
+        else:
+            bounds = self.bounds[:n]
+            dynamic = self.dynamic[:n]
+            found = [_sweep_strip(bounds, dynamic, left, right) for left, right in strips]
+
+        found = numpy.concatenate(found)
+
+        # entity order, like the pairs of a single strip
+        found = found[numpy.lexsort((found[:, 1], found[:, 0]))]
+
+        entities = self.entities
+
+        pairs = list()
+        for a, b in found.tolist():
+            eA = entities[a]
+            eB = entities[b]
+
+            if self.can_collide(eA, eB):
+                pairs.append((eA, eB))
+
+        return pairs
+
+    # The (left, right) edges of the strips. The outer strips reach out to infinity so colliders
+    # outside of the world still belong to a strip. Unbounded worlds are cut along the colliders.
+    def _get_strip_edges(self):
+
+        count = self.strips if self.strips is not None else self.processes
+        count = max(1, count)
+
+        world = self.world
+        if world is not None and world.is_bounded():
+            start = world.origin.x
+            width = float(world.width)
+        else:
+            left, top, right, bottom = self.get_extent()
+            start = left
+            width = float(right - left)
+
+        edges = [start + width * k / count for k in range(0, count + 1)]
+        edges[0] = -numpy.inf
+        edges[-1] = numpy.inf
+
+        return [(edges[k], edges[k + 1]) for k in range(0, count)]
+
+    def query(self, bounds):
+
+        n = len(self.entities)
+        if n == 0:
+            return []
+
+        left, top, right, bottom = self.bounds[:n].T
+
+        hit = (left <= bounds[2]) & (bounds[0] <= right) & (top <= bounds[3]) & (bounds[1] <= bottom)
+        return [self.entities[i] for i in numpy.nonzero(hit)[0].tolist()]
+
+    def get_extent(self):
+
+        n = len(self.entities)
+        if n == 0:
+            return None
+
+        bounds = self.bounds[:n]
+        left, top = bounds[:, :2].min(axis=0).tolist()
+        right, bottom = bounds[:, 2:].max(axis=0).tolist()
+
+        return left, top, right, bottom
+
+
+# Sweep the colliders that reach into the strip from strip_left to strip_right along the x axis.
+# Returns the (index A, index B) rows of the overlapping bounds where at least one entity is dynamic
+# and the left edge of the overlap is inside of the strip.
+def _sweep_strip(bounds, dynamic, strip_left, strip_right):
+
+    left, top, right, bottom = bounds.T
+
+    inside = numpy.nonzero((right >= strip_left) & (left < strip_right))[0]
+
+    # sort the colliders by their left edge
+    order = inside[numpy.argsort(left[inside], kind='mergesort')]
+    lefts = left[order]
+
+    # every collider is paired with the colliders after it that start before it ends
+    ends = numpy.searchsorted(lefts, right[order], side='right')
+    counts = ends - numpy.arange(1, len(order) + 1)
+
+    first = numpy.repeat(numpy.arange(len(order)), counts)
+    starts = numpy.cumsum(counts) - counts
+    second = first + 1 + numpy.arange(counts.sum()) - numpy.repeat(starts, counts)
+
+    a = order[first]
+    b = order[second]
+
+    overlap_left = numpy.maximum(left[a], left[b])
+
+    keep = ((top[a] <= bottom[b]) & (top[b] <= bottom[a]) & ((dynamic[a] != 0) | (dynamic[b] != 0)) &
+            (overlap_left >= strip_left) & (overlap_left < strip_right))
+
+    # the lower index first
+    a = a[keep]
+    b = b[keep]
+
+    return numpy.column_stack((numpy.minimum(a, b), numpy.maximum(a, b)))
+
+
+# The shared arrays of a worker process, set once when the process starts
+_worker_arrays = dict()
+
+
+def _init_strip_worker(shared_bounds, shared_dynamic, capacity):
+    _worker_arrays['bounds'] = numpy.frombuffer(shared_bounds, dtype=float).reshape(capacity, 4)
+    _worker_arrays['dynamic'] = numpy.frombuffer(shared_dynamic, dtype=numpy.int8)
+
+
+def _sweep_shared_strip(task):
+    n, strip_left, strip_right = task
+    return _sweep_strip(_worker_arrays['bounds'][:n], _worker_arrays['dynamic'][:n], strip_left, strip_right)
@@ -2,7 +2,13 @@
 from abc import abstractmethod
 
 from components import *
-from util_math import get_relative_rect_pos
+from broadphase import Broadphase
+from broadphase import DynamicTreeBroadphase
+from broadphase import bounds_overlap, bounds_contain, bounds_union
+from contacts import ContactManager
+from entity import BoxColliderObject
+
+from math import sqrt, ceil, floor
 
 import pygame
 
@@ -35,148 +41,867 @@ class PhysicsSystem (System):
     left = 2
     right = 3
 
+    # the side opposite to each of the sides above
+    opposite_side = (bottom, top, right, left)
+
     # This value represents a magnitude of velocity to ignore and treat it as zero
     ignore_velocity_epsilon = 10
 
-    # holds pairs of colliding entities per iteration.
-    collision_queue = list()
+    # Scratch rect for the square that bounds a circle colliding with a box.
+    # Reused by every circle to box response to avoid creating a box collider per test.
+    _circle_square = pygame.Rect(0, 0, 0, 0)
 
-    # holds the collisions of the past frame
-    #past_collisions = list()
+    # the axes of a box for the separating axis test
+    _box_axes = ((1.0, 0.0), (0.0, 1.0))
 
     def __init__(self):
         super(PhysicsSystem, self).__init__()
 
+        # holds pairs of colliding entities per iteration.
+        self.collision_queue = list()
+
         self.gravity = Vector2(0.0, 500.0)
         self.terminal_speed = 800
 
+        # Finds the pairs of entities that may be colliding. Assign a different
+        # Broadphase object to change the pair finding strategy, such as a
+        # SpatialHashBroadphase for worlds whose colliders have similar sizes.
+        self.broadphase = DynamicTreeBroadphase()
+
+        # The number of candidate pairs the broadphase reported in the last frame
+        self.candidate_pairs = 0
+
+        # Colliders that never move are kept out of the broadphase and indexed once
+        # in this tree. Only the dynamic bodies query it.
+        self.static_index = DynamicTreeBroadphase(margin=0)
+
+        # entities whose collider, rigid body or scripts changed since the last frame
+        self.changed_entities = list()
+
+        # Merge the touching static box colliders of the same material into larger boxes when
+        # baking, so the static index holds fewer and bigger colliders. See merge_static_boxes().
+        self.merge_static_colliders = False
+
+        # Maps the uuid of a merged box to its original entities and the uuid
+        # of each original entity to its merged box. Merged boxes have negative uuids.
+        self.merged_entities = dict()
+        self.merged_into = dict()
+        self._last_merged_uuid = 0
+
+        # Put bodies to sleep after they have been slower than the sleep speed while touching
+        # something for the sleep frames, along with every body they are touching (their island).
+        # Bodies that touch nothing, such as the ones drifting without gravity, stay awake.
+        # A body resting on the floor gains a couple of frames worth of gravity before the
+        # collision cancels it, so the sleep speed has to be larger than that.
+        self.allow_sleeping = True
+        self.sleep_speed = 30
+        self.sleep_frames = 60
+
+        # A resting body only collides every few frames, when gravity has pulled it back into what
+        # it rests on. It counts as touching something for this many frames after a collision.
+        self.support_frames = 4
+
+        # The sleeping bodies this close to a collider that is removed or changed are woken up
+        self.wake_margin = 1.0
+
+        # The entities whose rigid bodies are asleep. They are kept in the static index
+        # while asleep so the awake bodies can still collide with them.
+        self.sleeping_bodies = list()
+
+        # An optional backend that moves every rigid body at once, such as the NumpyIntegrator.
+        # None moves each body right before its collisions are tested.
+        self.integrator = None
+
+        # How far a continuous body is moved into the collider it would have skipped over,
+        # so that the narrowphase detects and resolves the hit in the same frame.
+        self.continuous_depth = 2.0
+
+        # Maps the uuid key of a pair to the continuous body and the side it hit the other entity with
+        # during its sweep in this frame. The sweep knows the side better than the box orientation test.
+        self.continuous_hits = dict()
+
+        # Split the motion of the fast bodies into sub-steps so that none of them moves further than
+        # substep_ratio of the smallest collider it may hit in one sub-step. Only the bodies that would
+        # move further than that are sub-stepped, so quiet frames still cost a single step.
+        # Off by default since it changes how the fast bodies of existing scenes move.
+        self.allow_substeps = False
+        self.substep_ratio = 0.5
+        self.max_substeps = 8
+
+        # The number of sub-steps in the last frame and the uuids of the bodies that took them
+        self.substeps = 1
+        self.substepped = set()
+
+        # Keeps the unique pairs to test and the contacts found between them during a frame
+        self.contact_manager = ContactManager()
+
+        # Maps the uuids of the entities removed from the world during this frame to the entities.
+        # The pairs of the frame are found before any script runs, so they may still hold them.
+        self.removed_entities = dict()
+
+        # An optional backend that tests the box to box and circle to circle candidate pairs
+        # in bulk, such as the BatchNarrowphase. Every body is moved before the pairs are tested
+        # and only the pairs that are really in contact are resolved.
+        self.batch_narrowphase = None
+
+        # In the deterministic mode of the engine the positions and velocities of the moving bodies
+        # are rounded to multiples of 1 / fixed_point_scale after every step. A power of two keeps them exact.
+        self.fixed_point_scale = 1024
+
+    # A static collider has no rigid body and is not treated as dynamic. Entities with scripts
+    # are left out because their scripts may move them, such as a paddle following the mouse.
+    @staticmethod
+    def is_static(entity):
+        return entity.collider is not None and not Broadphase.is_dynamic(entity) and not entity.scripts
+
+    # Index the static colliders. Called once the scene of the world has been loaded.
+    def bake_static_colliders(self, entities):
+
+        for e in self.sleeping_bodies:
+            self.wake(e)
+
+        del self.sleeping_bodies[:]
+
+        self.static_index.world = self.world
+        self.static_index.clear()
+        del self.changed_entities[:]
+
+        self.merged_entities.clear()
+        self.merged_into.clear()
+
+        static = [e for e in entities if PhysicsSystem.is_static(e)]
+
+        if self.merge_static_colliders:
+            static = self.merge_static_boxes(static)
+
+        for e in static:
+            self.static_index.insert(e)
+
+    # Merge the static box colliders that touch along a whole side and share the same tag and material
+    # (restitution, friction, trigger flag and layers) into larger boxes. The boxes are merged into rows
+    # first, then each row is merged with the rows below it that have the same left and right sides.
+    # Returns the entities to index: the merged boxes and the colliders that could not be merged.
+    #
+    # A merged box is an entity of its own that is only known by the physics system. It reports the
+    # collisions with the tag of its originals, see get_original_entities(). Destroying or changing
+    # one of the original entities splits the merged box back into the remaining originals.
+    def merge_static_boxes(self, entities):
+
+        result = list()
+        groups = dict()
+
+        for e in entities:
+            collider = e.collider
+
+            if collider.tag != BoxCollider.tag:
+                result.append(e)
+                continue
+
+            key = (e.tag, collider.restitution, collider.surface_friction, collider.is_trigger,
+                   collider.category, collider.mask)
+
+            groups.setdefault(key, []).append(e)
+
+        for group in groups.values():
+
+            # [left, top, right, bottom, original entities]
+            boxes = [list(e.collider.get_bounds()) + [[e]] for e in group]
+
+            # rows along the x axis, then columns of rows along the y axis
+            boxes = PhysicsSystem._merge_touching_boxes(boxes, 0)
+            boxes = PhysicsSystem._merge_touching_boxes(boxes, 1)
+
+            for left, top, right, bottom, originals in boxes:
+                if len(originals) == 1:
+                    result.append(originals[0])
+                else:
+                    result.append(self._create_merged_box(left, top, right, bottom, originals))
+
+        return result
+
+    # Merge the boxes that touch along the axis (0 for x, 1 for y) and have the same sides across it
+    @staticmethod
+    def _merge_touching_boxes(boxes, axis):
+
+        across = 1 - axis
+
+        boxes.sort(key=lambda box: (box[across], box[across + 2], box[axis]))
+
+        merged = list()
+        for box in boxes:
+
+            if merged:
+                last = merged[-1]
+
+                if last[across] == box[across] and last[across + 2] == box[across + 2] and last[axis + 2] == box[axis]:
+                    last[axis + 2] = box[axis + 2]
+                    last[4] = last[4] + box[4]
+                    continue
+
+            merged.append(box)
+
+        return merged
+
+    def _create_merged_box(self, left, top, right, bottom, originals):
+
+        self._last_merged_uuid -= 1
+
+        entity = BoxColliderObject(right - left, bottom - top, self._last_merged_uuid)
+        entity.tag = originals[0].tag
+        entity.world = self.world
+        entity.transform.position = Vector2(0.5 * (left + right), 0.5 * (top + bottom))
+
+        collider = entity.collider
+        material = originals[0].collider
+        collider.restitution = material.restitution
+        collider.surface_friction = material.surface_friction
+        collider.is_trigger = material.is_trigger
+        collider.category = material.category
+        collider.mask = material.mask
+
+        self.merged_entities[entity.uuid] = originals
+        for e in originals:
+            self.merged_into[e.uuid] = entity
+
+        return entity
+
+    # The original entities of a merged box, or a list of just the entity if it is not a merged box
+    def get_original_entities(self, entity):
+        return self.merged_entities.get(entity.uuid, [entity])
+
+    # Replace the merged box of the original entity by the other originals
+    def _split_merged_box(self, original):
+
+        merged = self.merged_into.get(original.uuid)
+        if merged is None:
+            return
+
+        self.static_index.remove(merged)
+
+        # the pairs of this frame may still hold the merged box
+        merged.disabled = True
+
+        for other in self.contact_manager.get_touching(merged):
+            self.wake(other)
+
+        for e in self.merged_entities.pop(merged.uuid):
+            del self.merged_into[e.uuid]
+
+            for other in self.contact_manager.get_touching(e):
+                self.wake(other)
+
+            if e is not original:
+
+                # scripts move positions directly, so refresh the bounds before indexing
+                e.transform.check_changed()
+                self.static_index.insert(e)
+
+    # Re-index an entity that was created or whose components changed after the scene was loaded.
+    # Call this as well after moving a static collider from another entity's script.
+    def entity_changed(self, entity):
+        self.changed_entities.append(entity)
+
+    def entity_removed(self, entity):
+        self.removed_entities[entity.uuid] = entity
+
+        # the bodies sleeping on the entity would float
+        self._wake_bodies_around(entity)
+
+        self._split_merged_box(entity)
+        self.static_index.remove(entity)
+
+        # and the ones it was in contact with
+        for other in self.contact_manager.remove_entity(entity):
+            self.wake(other)
+
+        if entity.rigid_body is not None and entity.rigid_body.sleeping:
+            self.sleeping_bodies = [e for e in self.sleeping_bodies if e is not entity]
+
+        # the entity may have been created in this same frame
+        self.changed_entities = [e for e in self.changed_entities if e is not entity]
+
+    def _update_static_index(self):
+
+        self.static_index.world = self.world
+
+        for e in self.changed_entities:
+            self.wake(e)
+
+            # the entity may have moved away from the bodies sleeping on it
+            self._wake_bodies_around(e)
+            for other in self.contact_manager.get_touching(e):
+                self.wake(other)
+
+            self._split_merged_box(e)
+            self.static_index.remove(e)
+
+            if PhysicsSystem.is_static(e):
+
+                # a script may have moved the entity without bumping the version of its transform
+                e.transform.check_changed()
+                self.static_index.insert(e)
+
+        del self.changed_entities[:]
+
     def process(self, entities):
-        # save the collisions of the past frame
-        #PhysicsSystem.past_collisions = PhysicsSystem.collision_queue[:]
 
         # empty the collision queue
-        del PhysicsSystem.collision_queue[:]
+        del self.collision_queue[:]
+        self.continuous_hits.clear()
+        self.removed_entities.clear()
+
+        if self.changed_entities:
+            self._update_static_index()
+
+        if self.sleeping_bodies:
+            self._wake_moved_bodies()
+
+        static_index = self.static_index
+
+        # Only the colliders that are not baked go through the broadphase.
+        # Colliders outside of every collision layer are left out completely.
+        merged_into = self.merged_into
+        moving = list()
+        for e in entities:
+            if e.collider is not None and not e.disabled and not static_index.contains(e):
+                if e.collider.has_layers() and e.uuid not in merged_into:
+
+                    # scripts move the transforms directly, catch those changes before any bounds are used
+                    e.transform.check_changed()
+                    moving.append(e)
+
+        # find the entities that may collide with each other
+        self.broadphase.world = self.world
+        self.broadphase.update(moving)
+        pairs = self.broadphase.get_pairs()
+
+        # find the static colliders around the dynamic entities
+        for e in moving:
+            if Broadphase.is_dynamic(e):
+                for static in static_index.query(static_index.get_swept_bounds(e)):
+                    if static_index.can_collide(e, static):
+                        static.transform.check_changed()
+                        pairs.append((e, static))
+
+        self.candidate_pairs = len(pairs)
+
+        self._plan_substeps(moving, pairs)
+
+        contact_manager = self.contact_manager
+        contact_manager.clear()
+        contact_manager.add_pairs(moving, pairs, self.substepped)
+
+        # move every rigid body in one batch
+        integrator = self.integrator
+        if integrator is not None:
+            bodies = [e for e in moving if e.rigid_body is not None and self._uses_integrator(e)]
+            integrator.integrate(bodies, self.world.engine.delta_time, self.gravity, self.terminal_speed)
+
+        if self.batch_narrowphase is not None:
+            self._batched_collisions(moving)
+        else:
+            self._sequential_collisions(moving)
+
+        self.collision_queue.extend(contact_manager.contacts)
+
+        if self.allow_sleeping:
+            self._update_sleeping(moving)
+
+        if self.world.engine.deterministic:
+            self._to_fixed_point(moving)
 
-        for eA in entities:
+        # trigger the collision enter, stay and exit events
+        contact_manager.fire_events(self._is_asleep)
 
-            # ignore disabled entities
-            if eA.disabled:
+    # Keep the state of the moving entities in fixed point
+    def _to_fixed_point(self, moving):
+
+        scale = float(self.fixed_point_scale)
+
+        for e in moving:
+            e.transform.position.to_fixed_point(scale)
+            e.transform.mark_changed()
+
+            if e.rigid_body is not None:
+                e.rigid_body.velocity.to_fixed_point(scale)
+
+    # Find the bodies to sub-step in this frame and the number of sub-steps. The fastest body
+    # decides the number of sub-steps from how far it moves compared to the smallest collider
+    # among the candidate pairs.
+    def _plan_substeps(self, moving, pairs):
+
+        self.substeps = 1
+        self.substepped.clear()
+
+        if not self.allow_substeps:
+            return
+
+        smallest = None
+        paired = set()
+
+        for pair in pairs:
+            for e in pair:
+                paired.add(e.uuid)
+
+                if e.collider.tag == TileCollisionMap.tag:
+                    extent = min(e.collider.tile_width, e.collider.tile_height)
+                else:
+                    left, top, right, bottom = e.collider.get_bounds()
+                    extent = min(right - left, bottom - top)
+
+                if extent > 0 and (smallest is None or extent < smallest):
+                    smallest = extent
+
+        if smallest is None:
+            return
+
+        dt = self.world.engine.delta_time
+
+        # the longest distance a body may move in one sub-step
+        max_step = self.substep_ratio * smallest
+
+        fastest = 0.0
+        for e in moving:
+
+            rigid_body = e.rigid_body
+
+            # continuous bodies are swept instead
+            if rigid_body is None or rigid_body.continuous or e.uuid not in paired:
+                continue
+
+            sq_displacement = rigid_body.velocity.sq_magnitude() * dt * dt
+
+            if sq_displacement > max_step * max_step:
+                self.substepped.add(e.uuid)
+                fastest = max(fastest, sq_displacement)
+
+        if self.substepped:
+            self.substeps = min(self.max_substeps, int(ceil(sqrt(fastest) / max_step)))
+
+    # The integrator moves the rigid bodies unless they are swept or sub-stepped
+    def _uses_integrator(self, entity):
+        return self.integrator is not None and not entity.rigid_body.continuous and \
+            entity.uuid not in self.substepped
+
+    # Move each rigid body and test the pairs of its turn right away
+    def _sequential_collisions(self, moving):
+
+        contact_manager = self.contact_manager
+
+        for e in moving:
+
+            # Move the rigid body
+            if e.rigid_body is not None and not self._uses_integrator(e):
+                self._move_body(e)
+
+            # entities without pairs are either static or far away from every other collider
+            for eA, eB in contact_manager.get_pairs(e):
+
+                if self._skips_pair(eA, eB):
+                    continue
+
+                eA, eB = PhysicsSystem._order_pair(eA, eB)
+
+                if PhysicsSystem._narrowphase(eA, eB, self._get_orientation(eA, eB)):
+                    self._add_contact(eA, eB)
+
+    # Move every rigid body first, then test the box to box and circle to circle
+    # pairs in bulk with the batch narrowphase. The other shapes are tested one by one.
+    def _batched_collisions(self, moving):
+
+        for e in moving:
+            if e.rigid_body is not None and not self._uses_integrator(e):
+                self._move_body(e)
+
+        contact_manager = self.contact_manager
+
+        batched = list()
+        others = list()
+
+        for e in moving:
+
+            for eA, eB in contact_manager.get_pairs(e):
+
+                if self._skips_pair(eA, eB):
+                    continue
+
+                eA, eB = PhysicsSystem._order_pair(eA, eB)
+
+                # the batch only compares the boxes, not the pixels
+                pixel_perfect = eA.collider.pixel_perfect or eB.collider.pixel_perfect
+
+                if eA.collider.tag == eB.collider.tag and eA.collider.tag in self.batch_narrowphase.tags and \
+                        not pixel_perfect:
+                    batched.append((eA, eB))
+                else:
+                    others.append((eA, eB))
+
+        for eA, eB, orientation, depth in self.batch_narrowphase.find_contacts(batched):
+
+            # the scripts of the earlier contacts may have removed the entities
+            if self._skips_pair(eA, eB):
                 continue
 
-            transform_a = eA.transform
             collider_a = eA.collider
-            rigid_body_a = eA.rigid_body
+            collider_b = eB.collider
+
+            if eA.rigid_body is not None and not collider_a.is_trigger and not collider_b.is_trigger:
 
-            valid_collider = collider_a is not None
+                if collider_a.tag == BoxCollider.tag:
 
-            # if there is a collider attached to the entity, then make sure that the
-            # entity also has a rigid body to modify or if the collider should trigger a collision event.
-            consider_entity = False
-            if valid_collider:
-                consider_entity = rigid_body_a is not None or collider_a.treat_as_dynamic
+                    known_orientation = self._get_orientation(eA, eB)
+                    if known_orientation is not None:
+                        orientation = known_orientation
+                        depth = None
 
-            if valid_collider and consider_entity:
+                    PhysicsSystem.box2box_response(collider_a, collider_b, orientation, depth)
+                else:
+                    PhysicsSystem.circle2circle_response(collider_a, collider_b)
 
-                # Move the rigid body
-                if rigid_body_a is not None:
-                    self._integrate_motion(transform_a, rigid_body_a)
+            self._add_contact(eA, eB)
 
-                # Find another entity that it may collide with
-                for eB in entities:
+        for eA, eB in others:
+            if not self._skips_pair(eA, eB) and PhysicsSystem._narrowphase(eA, eB, self._get_orientation(eA, eB)):
+                self._add_contact(eA, eB)
 
-                    if eB.disabled:
-                        continue
+    # The pairs of the disabled entities and of the entities removed from the world during this frame are not tested
+    def _skips_pair(self, eA, eB):
+
+        if eA.disabled or eB.disabled:
+            return True
+
+        removed = self.removed_entities
+        return len(removed) > 0 and (removed.get(eA.uuid) is eA or removed.get(eB.uuid) is eB)
+
+    # Record the contact of a pair that collided, call its collision events and wake up its sleeping
+    # bodies. A merged box is replaced by the original entity closest to the other entity, so the
+    # scripts are given colliders of entities that exist in the world.
+    def _add_contact(self, eA, eB):
+
+        if eA.uuid in self.merged_entities:
+            eA = self._get_closest_original(eA, eB)
+
+        elif eB.uuid in self.merged_entities:
+            eB = self._get_closest_original(eB, eA)
+
+        self.contact_manager.add_contact(eA, eB)
+        self._wake_hit_bodies(eA, eB)
+
+    # the original entity of the merged box whose bounds are the closest to the center of the other entity
+    def _get_closest_original(self, merged, other):
+
+        bounds = other.collider.get_bounds()
+        x = 0.5 * (bounds[0] + bounds[2])
+        y = 0.5 * (bounds[1] + bounds[3])
+
+        return min(self.merged_entities[merged.uuid],
+                   key=lambda e: PhysicsSystem._sq_distance_to_bounds(x, y, e.collider.get_bounds()))
+
+    # wake up the sleeping bodies of a pair that collided
+    def _wake_hit_bodies(self, eA, eB):
+
+        if eA.collider.is_trigger or eB.collider.is_trigger:
+            return
 
-                    transform_b = eB.transform
-                    collider_b = eB.collider
-
-                    # Check that coll_comp_b is valid and that coll_comp_a is not colliding with itself
-                    if collider_b is not None and eA is not eB:
-
-                        collision_occurred = False
-
-                        # A flag to tell the physics systems not to apply physics or collision
-                        # resolution on the entity if this collider collides with another collider.
-                        b_isnt_trigger = not collider_b.is_trigger
-                        a_isnt_trigger = not collider_a.is_trigger
-
-                        # box to box collision
-                        if collider_a.tag == BoxCollider.tag and collider_b.tag == BoxCollider.tag:
-
-                            # check for collision
-                            if PhysicsSystem.box2box_collision(collider_a, collider_b):
-                                collision_occurred = True
-
-                                if rigid_body_a is not None and b_isnt_trigger and a_isnt_trigger:
-                                    PhysicsSystem.box2box_response(collider_a, collider_b)
-
-                        # circle to circle collision
-                        elif collider_a.tag == CircleCollider.tag and collider_b.tag == CircleCollider.tag:
-
-                            # check if circles collided
-                            if PhysicsSystem._circle2circle_collision(collider_a, collider_b):
-                                collision_occurred = True
-
-                                if rigid_body_a is not None and b_isnt_trigger and a_isnt_trigger:
-                                    PhysicsSystem.circle2circle_response(collider_a, collider_b)
-
-                        # circle to box
-                        elif collider_a.tag == CircleCollider.tag and collider_b.tag == BoxCollider.tag:
-
-                            # create a temporary box collider associated to A
-                            box_collider_a = BoxCollider(collider_a.radius*2, collider_a.radius*2)
-                            box_collider_a.entity = collider_a.entity
-                            box_collider_a.restitution = collider_a.restitution
-                            box_collider_a.surface_friction = collider_a.surface_friction
-
-                            # Get the relative collision box positions to their transforms.
-                            get_relative_rect_pos(transform_a.position, box_collider_a)
-                            get_relative_rect_pos(transform_b.position, collider_b)
-
-                            # check for collision
-                            if PhysicsSystem._circle2box_collision(collider_a, collider_b):
-                                collision_occurred = True
-
-                                if rigid_body_a is not None and b_isnt_trigger and a_isnt_trigger:
-                                    PhysicsSystem.box2box_response(box_collider_a, collider_b)
-
-                        if collision_occurred:
-                            # add collision event into the queue
-                            PhysicsSystem.collision_queue.append((eA, eB))
-
-                            # call the collision inside the scripts
-                            for s in eA.scripts:
-                                s.collision_event(collider_b)
-
-                            for s in eB.scripts:
-                                s.collision_event(collider_a)
-
-        # trigger the collision exit event
-        # An exit event means  that the an object is no longer colliding with another.
-        # We can test this by checking the past collisions and seeing if they are NOT
-        # in the current collision event queue.
-        # for past_collision in PhysicsSystem.past_collisions:
-        #     trigger_exit = True
-        #
-        #     for current_collision in PhysicsSystem.collision_queue:
-        #
-        #         # If the collisions are the same then don't trigger collision exit event
-        #         if past_collision == current_collision:
-        #             trigger_exit = False
-        #             break
-        #
-        #     # The inner for loop failed which means that there was a collision exit event
-        #     if trigger_exit and self.world.engine.delta_time > 0.011:
-        #
-        #         eA = past_collision[0]
-        #         eB = past_collision[1]
-        #
-        #         # call the collision exit inside the scripts
-        #         for s in eA.scripts:
-        #             s.collision_exit_event(eB.collider)
-        #
-        #         for s in eB.scripts:
-        #             s.collision_exit_event(eA.collider)
+        for e in (eA, eB):
+            if e.rigid_body is not None and e.rigid_body.sleeping:
+                self.wake(e)
+
+    # Order the entities of a pair the way the narrowphase expects them. The circle comes first
+    # when a circle meets a box and a tile map comes second. Otherwise an entity with a rigid body comes first since only
+    # the first entity of a pair gets a collision response when the other has no rigid body.
+    @staticmethod
+    def _order_pair(eA, eB):
+
+        tag_a = eA.collider.tag
+        tag_b = eB.collider.tag
+
+        if tag_a != tag_b:
+            if tag_a == BoxCollider.tag and tag_b == CircleCollider.tag:
+                return eB, eA
+
+            # the tile map goes second
+            if tag_a == TileCollisionMap.tag:
+                return eB, eA
+
+            # a polygon resolves against any shape, so the rigid body goes first
+            if PolygonCollider.tag in (tag_a, tag_b) and eA.rigid_body is None and eB.rigid_body is not None:
+                return eB, eA
+
+        elif eA.rigid_body is None and eB.rigid_body is not None:
+            return eB, eA
+
+        return eA, eB
+
+    # The side of entity A that hit entity B when it is known better than from the centers of the boxes,
+    # which give the wrong side near the ends of long merged boxes. None to compute it from the centers.
+    def _get_orientation(self, eA, eB):
+
+        orientation = self._continuous_orientation(eA, eB)
+        if orientation is not None:
+            return orientation
+
+        merged_entities = self.merged_entities
+        if merged_entities and (eA.uuid in merged_entities or eB.uuid in merged_entities):
+            return PhysicsSystem.calc_bounds_hit_orientation(eA.collider.get_bounds(), eB.collider.get_bounds())
+
+        return None
+
+    # The side of entity A that hit entity B according to the sweep of a continuous body.
+    # None if neither of them is a continuous body that hit the other in this frame.
+    def _continuous_orientation(self, eA, eB):
+
+        if not self.continuous_hits:
+            return None
+
+        hit = self.continuous_hits.get(ContactManager.get_key(eA, eB))
+        if hit is None:
+            return None
+
+        entity, orientation = hit
+        if entity is eA:
+            return orientation
+
+        return PhysicsSystem.opposite_side[orientation]
+
+    # Test the entities for collision and apply the collision response to them if they
+    # collided. Both of them are resolved when they both have rigid bodies, otherwise
+    # only A is. The orientation of boxes is computed unless it is given.
+    # Returns True if they collided.
+    @staticmethod
+    def _narrowphase(eA, eB, orientation=None):
+
+        transform_a = eA.transform
+
+        collider_a = eA.collider
+        collider_b = eB.collider
+
+        rigid_body_a = eA.rigid_body
+
+        collision_occurred = False
+
+        # A flag to tell the physics systems not to apply physics or collision
+        # resolution on the entity if this collider collides with another collider.
+        b_isnt_trigger = not collider_b.is_trigger
+        a_isnt_trigger = not collider_a.is_trigger
+
+        # box to box collision
+        if collider_a.tag == BoxCollider.tag and collider_b.tag == BoxCollider.tag:
+
+            # check for collision
+            if PhysicsSystem.box2box_collision(collider_a, collider_b):
+                collision_occurred = True
+
+                if rigid_body_a is not None and b_isnt_trigger and a_isnt_trigger:
+                    PhysicsSystem.box2box_response(collider_a, collider_b, orientation)
+
+        # circle to circle collision
+        elif collider_a.tag == CircleCollider.tag and collider_b.tag == CircleCollider.tag:
+
+            # check if circles collided
+            if PhysicsSystem._circle2circle_collision(collider_a, collider_b):
+                collision_occurred = True
+
+                if rigid_body_a is not None and b_isnt_trigger and a_isnt_trigger:
+                    PhysicsSystem.circle2circle_response(collider_a, collider_b)
+
+        # circle to box
+        elif collider_a.tag == CircleCollider.tag and collider_b.tag == BoxCollider.tag:
+
+            # Get the relative collision box position to its transform.
+            collider_b.place_box()
+
+            # check for collision
+            hit = PhysicsSystem._circle2box_collision(collider_a, collider_b)
+
+            # the pixels are only compared once the shapes overlap
+            if hit and collider_b.pixel_perfect:
+                position = transform_a.position
+                r = int(collider_a.radius)
+                hit = PhysicsSystem.pixel_collision(collider_a, position.x - r, position.y - r,
+                                                    collider_b, collider_b.box.x, collider_b.box.y)
+
+            if hit:
+                collision_occurred = True
+
+                if rigid_body_a is not None and b_isnt_trigger and a_isnt_trigger:
+                    PhysicsSystem.circle2box_response(collider_a, collider_b, orientation)
+
+        # box or circle to tile map
+        elif collider_b.tag == TileCollisionMap.tag and collider_a.tag != TileCollisionMap.tag:
+
+            resolve = rigid_body_a is not None and b_isnt_trigger and a_isnt_trigger
+            collision_occurred = PhysicsSystem.tile_map_collision(collider_a, collider_b, resolve)
+
+        # polygon to polygon, box or circle
+        elif collider_a.tag == PolygonCollider.tag or collider_b.tag == PolygonCollider.tag:
+
+            # the bounds rule out most pairs before the separating axes are tested
+            if bounds_overlap(collider_a.get_bounds(), collider_b.get_bounds()):
+                hit = PhysicsSystem.sat_collision(collider_a, collider_b)
+
+                if hit is not None:
+                    collision_occurred = True
+
+                    if rigid_body_a is not None and b_isnt_trigger and a_isnt_trigger:
+                        nx, ny, depth = hit
+                        PhysicsSystem.sat_response(collider_a, collider_b, nx, ny, depth)
+
+        return collision_occurred
+
+    # A sleeping body is kept in the static index until it wakes up or is destroyed
+    def _is_asleep(self, entity):
+        rigid_body = entity.rigid_body
+        return rigid_body is not None and rigid_body.sleeping and self.static_index.contains(entity)
+
+    # Wake up a sleeping body along with the rest of its island
+    def wake(self, entity):
+
+        rigid_body = entity.rigid_body
+        if rigid_body is None or not rigid_body.sleeping:
+            return
+
+        for e in rigid_body.island:
+
+            other_body = e.rigid_body
+            if other_body is None or not other_body.sleeping:
+                continue
+
+            other_body.sleeping = False
+            other_body.sleep_timer = 0
+            other_body.island = None
+            other_body.sleep_position = None
+
+            self.static_index.remove(e)
+
+    # Wake up the sleeping bodies around the bounds the entity was indexed with, or its current bounds if it
+    # is not indexed. A resting body only collides every few frames, so it may have no contact with what
+    # it rests on when it falls asleep.
+    def _wake_bodies_around(self, entity):
+
+        static_index = self.static_index
+
+        bounds = static_index.get_indexed_bounds(entity)
+        if bounds is None:
+            if entity.collider is None or entity.transform is None:
+                return
+            bounds = entity.collider.get_bounds()
+
+        margin = self.wake_margin
+        for other in static_index.query((bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin)):
+            if other is not entity:
+                self.wake(other)
+
+    # Wake up the sleeping bodies that were moved or given a velocity by a script
+    def _wake_moved_bodies(self):
+
+        for e in self.sleeping_bodies:
+
+            rigid_body = e.rigid_body
+            if rigid_body is None or not rigid_body.sleeping:
+                continue
+
+            position = e.transform.position
+            x, y = rigid_body.sleep_position
+
+            if position.x != x or position.y != y or not rigid_body.velocity.is_zero():
+                self.wake(e)
+
+        # forget about the bodies that woke up
+        self.sleeping_bodies = [e for e in self.sleeping_bodies
+                                if e.rigid_body is not None and e.rigid_body.sleeping]
+
+    # Group the awake bodies that are touching into islands and put
+    # an island to sleep once all of its bodies have been slow long enough.
+    def _update_sleeping(self, moving):
+
+        sq_sleep_speed = self.sleep_speed * self.sleep_speed
+
+        # union find of the bodies. Maps a uuid to the uuid of its parent
+        parents = dict()
+        bodies = dict()
+
+        # the bodies that touched something in this frame
+        touching = set()
+        for eA, eB in self.collision_queue:
+            if not eA.collider.is_trigger and not eB.collider.is_trigger:
+                touching.add(eA.uuid)
+                touching.add(eB.uuid)
+
+        support_frames = self.support_frames
+
+        for e in moving:
+
+            rigid_body = e.rigid_body
+            if rigid_body is None or rigid_body.sleeping:
+                continue
+
+            if e.uuid in touching:
+                rigid_body.untouched_frames = 0
+            else:
+                rigid_body.untouched_frames += 1
+
+            if rigid_body.untouched_frames <= support_frames and rigid_body.velocity.sq_magnitude() < sq_sleep_speed:
+                rigid_body.sleep_timer += 1
+            else:
+                rigid_body.sleep_timer = 0
+
+            parents[e.uuid] = e.uuid
+            bodies[e.uuid] = e
+
+        # bodies that touch each other belong to the same island
+        for eA, eB in self.collision_queue:
+
+            if eA.uuid not in parents or eB.uuid not in parents:
+                continue
+
+            if eA.collider.is_trigger or eB.collider.is_trigger:
+                continue
+
+            root_a = PhysicsSystem._find_root(parents, eA.uuid)
+            root_b = PhysicsSystem._find_root(parents, eB.uuid)
+
+            if root_a != root_b:
+                parents[root_a] = root_b
+
+        islands = dict()
+        for uuid in parents:
+            islands.setdefault(PhysicsSystem._find_root(parents, uuid), []).append(bodies[uuid])
+
+        sleep_frames = self.sleep_frames
+
+        for island in islands.values():
+
+            ready = True
+            for e in island:
+                if e.rigid_body.sleep_timer < sleep_frames:
+                    ready = False
+                    break
+
+            if not ready:
+                continue
+
+            for e in island:
+                rigid_body = e.rigid_body
+                rigid_body.sleeping = True
+                rigid_body.island = island
+                rigid_body.sleep_position = e.transform.position.to_tuple()
+
+                # the velocity vector may be shared with other bodies so replace it
+                rigid_body.velocity = Vector2(0.0, 0.0)
+
+                self.static_index.insert(e)
+                self.sleeping_bodies.append(e)
+
+    @staticmethod
+    def _find_root(parents, uuid):
+        while parents[uuid] != uuid:
+
+            # path halving
+            parents[uuid] = parents[parents[uuid]]
+            uuid = parents[uuid]
+
+        return uuid
 
     @staticmethod
     def _calc_1d_elastic_collision_velocity(vel_a, mass_a, vel_b, mass_b):
@@ -217,14 +942,39 @@ class PhysicsSystem (System):
         # Collision occurs if the distance from the center of the circle to the closest point on the box
         # is less than the radius of the circle.
 
-        distance_to_closest = Vector2(x_closest, y_closest)
-
-        distance_to_closest -= collider_a.entity.transform.position
+        dx = x_closest - position_a.x
+        dy = y_closest - position_a.y
 
         # square radius
         r_sq = collider_a.radius * collider_a.radius
 
-        return distance_to_closest.sq_magnitude() < r_sq
+        return dx * dx + dy * dy < r_sq
+
+    # The circle bounces off the box like the square that bounds it would.
+    # collider a is the circle
+    # collider b is the box, its rect has to be placed relative to its transform
+    @staticmethod
+    def circle2box_response(collider_a, collider_b, orientation=None):
+
+        position_a = collider_a.entity.transform.position
+        position_b = collider_b.entity.transform.position
+
+        square = PhysicsSystem._circle_square
+        square.width = square.height = collider_a.radius * 2
+        square.x = position_a.x - square.width/2
+        square.y = position_a.y - square.height/2
+
+        box = collider_b.box
+
+        if orientation is None:
+            orientation = PhysicsSystem.calc_hit_orientation(0.5 * (square.width + box.width),
+                                                             0.5 * (square.height + box.height),
+                                                             position_b.x - position_a.x,
+                                                             position_a.y - position_b.y)
+
+        depth = PhysicsSystem.calc_box_penetration(orientation, square, box)
+
+        PhysicsSystem.box2box_response(collider_a, collider_b, orientation, depth)
 
     @staticmethod
     def _circle2circle_collision(collider_a, collider_b):
@@ -313,6 +1063,7 @@ class PhysicsSystem (System):
             #rigid_b.velocity *= collider_a.restitution
 
 
+    # Both circles are pushed out of each other by half of the overlap
     @staticmethod
     def _resolve_circle2circle_with_rigid(transform_a, collider_a, transform_b, collider_b):
 
@@ -332,7 +1083,10 @@ class PhysicsSystem (System):
         transform_a.position -= overlap_vec
 
         # same resolve for b but in the other direction
-        #transform_b.position += overlap_vec
+        transform_b.position += overlap_vec
+
+        transform_a.mark_changed()
+        transform_b.mark_changed()
 
     # Same as with_rigid() but collider_b's rigid does not exist
     @staticmethod
@@ -348,19 +1102,238 @@ class PhysicsSystem (System):
         overlap_vec = normal_ab * overlap_mag
         transform_a.position -= overlap_vec
 
+        transform_a.mark_changed()
+
+    # Test the box or circle collider against the solid tiles under its bounds and push it out of each
+    # tile it overlaps, like a box collider hitting a static box collider, if resolve is True.
+    # A circle is resolved as the square that bounds it, like against a box, and a polygon as its bounds. Returns True if it hit a tile.
+    @staticmethod
+    def tile_map_collision(collider_a, tile_map, resolve):
+
+        hit = False
+
+        first_column, first_row, last_column, last_row = tile_map.get_cell_range(collider_a.get_bounds())
+
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+
+                if not tile_map.get_tile(column, row):
+                    continue
+
+                # the previous tiles may have pushed the collider out of this one
+                left, top, right, bottom = collider_a.get_bounds()
+                tile_left, tile_top, tile_right, tile_bottom = tile_map.get_tile_bounds(column, row)
+
+                if collider_a.tag == CircleCollider.tag:
+                    position = collider_a.entity.transform.position
+
+                    # closest point of the tile to the center of the circle
+                    dx = min(max(position.x, tile_left), tile_right) - position.x
+                    dy = min(max(position.y, tile_top), tile_bottom) - position.y
+
+                    if dx * dx + dy * dy >= collider_a.radius * collider_a.radius:
+                        continue
+
+                # same test as Rect.colliderect
+                elif not (left < tile_right and tile_left < right and top < tile_bottom and tile_top < bottom):
+                    continue
+
+                hit = True
+
+                if not resolve:
+                    continue
+
+                orientation = PhysicsSystem.calc_hit_orientation(0.5 * (right - left + tile_map.tile_width),
+                                                                 0.5 * (bottom - top + tile_map.tile_height),
+                                                                 0.5 * (tile_left + tile_right - left - right),
+                                                                 0.5 * (top + bottom - tile_top - tile_bottom))
+
+                if orientation == PhysicsSystem.top:
+                    depth = tile_bottom - top
+                elif orientation == PhysicsSystem.bottom:
+                    depth = bottom - tile_top
+                elif orientation == PhysicsSystem.left:
+                    depth = tile_right - left
+                else:
+                    depth = right - tile_left
+
+                PhysicsSystem.box2box_response(collider_a, tile_map, orientation, depth)
+
+        return hit
+
+    # The world space vertices, the axes to test and the center of a collider for the separating axis test.
+    # A box gives the corners of its box, a circle has no vertices or axes of its own.
+    @staticmethod
+    def _sat_shape(collider):
+
+        if collider.tag == PolygonCollider.tag:
+            vertices = collider.get_world_vertices()
+            x = sum(v[0] for v in vertices) / float(len(vertices))
+            y = sum(v[1] for v in vertices) / float(len(vertices))
+            return vertices, collider.get_normals(), (x, y)
+
+        if collider.tag == CircleCollider.tag:
+            position = collider.entity.transform.position
+            return (), (), (position.x, position.y)
+
+        left, top, right, bottom = collider.get_bounds()
+        vertices = ((left, top), (right, top), (right, bottom), (left, bottom))
+        return vertices, PhysicsSystem._box_axes, (0.5 * (left + right), 0.5 * (top + bottom))
+
+    # The (min, max) interval of the collider projected onto the axis
+    @staticmethod
+    def _sat_project(collider, vertices, nx, ny):
+
+        if collider.tag == CircleCollider.tag:
+            position = collider.entity.transform.position
+            center = position.x * nx + position.y * ny
+            return center - collider.radius, center + collider.radius
+
+        low = high = vertices[0][0] * nx + vertices[0][1] * ny
+        for x, y in vertices:
+            d = x * nx + y * ny
+            if d < low:
+                low = d
+            elif d > high:
+                high = d
+
+        return low, high
+
+    # Separating axis test between a polygon and a polygon, a box or a circle. The shapes overlap unless their
+    # projections are apart on one of the edge normals, or on the axis from the center of a circle to the closest
+    # vertex of the other shape. Returns (nx, ny, depth): the axis of least overlap as a unit normal pointing
+    # from A to B and the overlap along it. None if they do not overlap.
+    @staticmethod
+    def sat_collision(collider_a, collider_b):
+
+        # a polygon without vertices has no shape
+        for collider in (collider_a, collider_b):
+            if collider.tag == PolygonCollider.tag and not collider.vertices:
+                return None
+
+        vertices_a, axes_a, center_a = PhysicsSystem._sat_shape(collider_a)
+        vertices_b, axes_b, center_b = PhysicsSystem._sat_shape(collider_b)
+
+        axes = list(axes_a)
+        axes.extend(axes_b)
+
+        for circle, vertices in ((collider_a, vertices_b), (collider_b, vertices_a)):
+            if circle.tag != CircleCollider.tag or not vertices:
+                continue
+
+            position = circle.entity.transform.position
+            closest = min(vertices, key=lambda v: (v[0] - position.x) ** 2 + (v[1] - position.y) ** 2)
+
+            dx = closest[0] - position.x
+            dy = closest[1] - position.y
+            length = sqrt(dx * dx + dy * dy)
+            if length > 0:
+                axes.append((dx / length, dy / length))
+
+        depth = None
+        normal = None
+
+        for nx, ny in axes:
+            min_a, max_a = PhysicsSystem._sat_project(collider_a, vertices_a, nx, ny)
+            min_b, max_b = PhysicsSystem._sat_project(collider_b, vertices_b, nx, ny)
+
+            overlap = min(max_a, max_b) - max(min_a, min_b)
+
+            # found a separating axis
+            if overlap <= 0:
+                return None
+
+            if depth is None or overlap < depth:
+                depth = overlap
+                normal = (nx, ny)
+
+        if normal is None:
+            return None
+
+        nx, ny = normal
+        if (center_b[0] - center_a[0]) * nx + (center_b[1] - center_a[1]) * ny < 0:
+            nx = -nx
+            ny = -ny
+
+        return nx, ny, depth
+
+    # Push the colliders out of each other along the normal from A to B, by half of the depth each when both
+    # have rigid bodies and by half of it for A alone otherwise, like boxes. The velocities moving into the
+    # other collider bounce off of it.
+    @staticmethod
+    def sat_response(collider_a, collider_b, nx, ny, depth):
+
+        rigid_a = collider_a.entity.rigid_body
+        rigid_b = collider_b.entity.rigid_body
+
+        transform_a = collider_a.entity.transform
+        transform_b = collider_b.entity.transform
+
+        delta = depth * 0.5
+
+        transform_a.position.x -= nx * delta
+        transform_a.position.y -= ny * delta
+        transform_a.mark_changed()
+
+        if rigid_b is not None:
+            transform_b.position.x += nx * delta
+            transform_b.position.y += ny * delta
+            transform_b.mark_changed()
+
+            PhysicsSystem._bounce_off(rigid_b.velocity, -nx, -ny, collider_a)
+
+        if rigid_a is not None:
+            PhysicsSystem._bounce_off(rigid_a.velocity, nx, ny, collider_b)
+
+    # Reflect the part of the velocity that goes along the normal, into the surface, scaled by the restitution
+    # of the surface and scale the rest by its friction. Small bounces off of colliders that do not move are
+    # dropped to avoid jittery behavior, like between boxes.
+    @staticmethod
+    def _bounce_off(velocity, nx, ny, surface):
+
+        speed = velocity.x * nx + velocity.y * ny
+
+        # moving away from the surface already
+        if speed <= 0:
+            return
+
+        tangent_x = velocity.x - speed * nx
+        tangent_y = velocity.y - speed * ny
+
+        bounce = speed * surface.restitution
+        if surface.entity.rigid_body is None and bounce < PhysicsSystem.ignore_velocity_epsilon:
+            bounce = 0
+
+        velocity.x = tangent_x * surface.surface_friction - nx * bounce
+        velocity.y = tangent_y * surface.surface_friction - ny * bounce
+
     @staticmethod
     # test if two box colliders are colliding
     def box2box_collision(collider_a, collider_b):
 
         # offset the collision boxes relative to their transform positions
-        get_relative_rect_pos(collider_a.entity.transform.position, collider_a)
-        get_relative_rect_pos(collider_b.entity.transform.position, collider_b)
+        collider_a.place_box()
+        collider_b.place_box()
 
         # check for collision
         if collider_a.box.colliderect(collider_b.box):
+
+            # the pixels are only compared once the boxes overlap
+            if collider_a.pixel_perfect or collider_b.pixel_perfect:
+                return PhysicsSystem.pixel_collision(collider_a, collider_a.box.x, collider_a.box.y,
+                                                     collider_b, collider_b.box.x, collider_b.box.y)
             return True
         return False
 
+    # Test if the masks of the colliders overlap, given the top left corners of their masks
+    @staticmethod
+    def pixel_collision(collider_a, left_a, top_a, collider_b, left_b, top_b):
+
+        mask_a = MaskCollider.get_shape_mask(collider_a)
+        mask_b = MaskCollider.get_shape_mask(collider_b)
+
+        return mask_a.overlap(mask_b, (int(left_b - left_a), int(top_b - top_a))) is not None
+
     # test if the tolerance hitboxes of the entities overlap
     @staticmethod
     def tolerance_collision(collider_a, collider_b):
@@ -401,6 +1374,35 @@ class PhysicsSystem (System):
         dx = position_b.x - position_a.x
         dy = position_a.y - position_b.y
 
+        return PhysicsSystem.calc_hit_orientation(width, height, dx, dy)
+
+    # Determine the side of bounds a that hit bounds b from the axis they overlap the least along,
+    # which does not depend on the sizes of the bounds like the distance between the centers does
+    @staticmethod
+    def calc_bounds_hit_orientation(bounds_a, bounds_b):
+
+        overlap_x = min(bounds_a[2], bounds_b[2]) - max(bounds_a[0], bounds_b[0])
+        overlap_y = min(bounds_a[3], bounds_b[3]) - max(bounds_a[1], bounds_b[1])
+
+        if overlap_y <= overlap_x:
+
+            # a is below b
+            if bounds_a[1] + bounds_a[3] > bounds_b[1] + bounds_b[3]:
+                return PhysicsSystem.top
+
+            return PhysicsSystem.bottom
+
+        # a is right of b
+        if bounds_a[0] + bounds_a[2] > bounds_b[0] + bounds_b[2]:
+            return PhysicsSystem.left
+
+        return PhysicsSystem.right
+
+    # Determine the side that was hit from the half extents of the Minkowski sum and
+    # the distance between the centers (dy is positive when b is above a).
+    @staticmethod
+    def calc_hit_orientation(width, height, dx, dy):
+
         # Another way to detect collision
         # if abs(dx) <= width and abs(dy) <= height:
 
@@ -434,8 +1436,10 @@ class PhysicsSystem (System):
     # rigid bodies are entities that do not rotate their collision polygons.
     # Basically, they are treated as particles
     # This should be called if there was a detected collision
+    # The orientation and penetration depth can be passed in when they are already known,
+    # such as from the batch narrowphase. Otherwise they are computed from the collider boxes.
     @staticmethod
-    def box2box_response(collider_a, collider_b):
+    def box2box_response(collider_a, collider_b, orientation=None, depth=None):
 
         rigid_a = collider_a.entity.rigid_body
         rigid_b = collider_b.entity.rigid_body
@@ -445,7 +1449,9 @@ class PhysicsSystem (System):
         transform_b = collider_b.entity.transform
 
         x_change = y_change = 1
-        orientation = PhysicsSystem.calc_box_hit_orientation(collider_a, collider_b)
+        if orientation is None:
+            orientation = PhysicsSystem.calc_box_hit_orientation(collider_a, collider_b)
+
         if orientation == PhysicsSystem.top or orientation == PhysicsSystem.bottom:
             y_change = -1
 
@@ -455,7 +1461,8 @@ class PhysicsSystem (System):
         # Apply collision resolution to avoid colliders getting stuck with each other
         # Collision with rigid body
         if rigid_b is not None:
-            PhysicsSystem._resolve_box2box_with_rigid(orientation, transform_a, collider_a, transform_b, collider_b)
+            PhysicsSystem._resolve_box2box_with_rigid(orientation, transform_a, collider_a, transform_b, collider_b,
+                                                      depth)
 
             # mass_a = rigid_a.mass
             # mass_b = rigid_b.mass
@@ -470,133 +1477,454 @@ class PhysicsSystem (System):
             #
             # rigid_a.velocity.y = PhysicsSystem._calc_1d_elastic_collision_velocity(vel_a, mass_a, vel_b, mass_b)
 
-            if orientation == PhysicsSystem.top or orientation == PhysicsSystem.bottom:
-                rigid_b.velocity.y *= collider_a.restitution
-                rigid_b.velocity.x *= collider_a.surface_friction
+            if orientation == PhysicsSystem.top or orientation == PhysicsSystem.bottom:
+                rigid_b.velocity.y *= collider_a.restitution
+                rigid_b.velocity.x *= collider_a.surface_friction
+
+            elif orientation == PhysicsSystem.left or orientation == PhysicsSystem.right:
+                rigid_b.velocity.x *= collider_a.restitution
+                #rigid_a.velocity.y *= collider_b.surface_friction
+
+            # Invert velocities according to orientation
+            rigid_b.velocity.x *= x_change
+            rigid_b.velocity.y *= y_change
+
+        # Collision with another collider only
+        else:
+            PhysicsSystem._resolve_box2box_with_collider(orientation, transform_a, collider_a, collider_b, depth)
+
+        # This was collider with collider collision. This means that the collider is treated
+        # as a dynamic body that moves and needed collision resolution to be applied.
+        if rigid_a is None:
+            return
+
+        # Invert velocity components depending on which side of the boxes hit
+        rigid_a.velocity.x *= x_change
+        rigid_a.velocity.y *= y_change
+
+        # Apply restitution based on the orientation that the boxes hit
+        # and apply frictional forces between the collider's surfaces
+        if orientation == PhysicsSystem.top or orientation == PhysicsSystem.bottom:
+            rigid_a.velocity.y *= collider_b.restitution
+            rigid_a.velocity.x *= collider_b.surface_friction
+
+        elif orientation == PhysicsSystem.left or orientation == PhysicsSystem.right:
+            rigid_a.velocity.x *= collider_b.restitution
+            #rigid_a.velocity.y *= collider_b.surface_friction
+
+        # Zero out velocity components if they are too small in order to avoid
+        # jittery behavior between a moving collider and a static one.
+        if rigid_b is None:
+            if abs(rigid_a.velocity.y) < PhysicsSystem.ignore_velocity_epsilon:
+                if orientation == PhysicsSystem.top or orientation == PhysicsSystem.bottom:
+                    rigid_a.velocity.y = 0
+
+            if abs(rigid_a.velocity.x) < PhysicsSystem.ignore_velocity_epsilon:
+                if orientation == PhysicsSystem.left or orientation == PhysicsSystem.right:
+                    rigid_a.velocity.x = 0
+
+    # the amount that rect a went into rect b along the side that it hit
+    @staticmethod
+    def calc_box_penetration(orientation, box_a, box_b):
+
+        if orientation == PhysicsSystem.top:
+            return box_b.bottom - box_a.top
+
+        elif orientation == PhysicsSystem.bottom:
+            return box_a.bottom - box_b.top
+
+        elif orientation == PhysicsSystem.left:
+            return box_b.right - box_a.left
+
+        return box_a.right - box_b.left
+
+    # Both boxes are pushed out of each other by half of the penetration
+    @staticmethod
+    def _resolve_box2box_with_rigid(orient, transform_a, collider_a, transform_b, collider_b, depth=None):
+
+        # amount that coll_comp_a went into coll_comp_b
+        if depth is None:
+            depth = PhysicsSystem.calc_box_penetration(orient, collider_a.box, collider_b.box)
+
+        delta = depth * 0.5
+
+        if orient == PhysicsSystem.top:
+
+            # move coll_comp_a out of coll_comp_b by translating it downwards
+            transform_a.position.y += delta
+
+            # translate entity_b upwards
+            transform_b.position.y -= delta
+
+        elif orient == PhysicsSystem.bottom:
+
+            # translate upwards
+            transform_a.position.y -= delta
+            transform_b.position.y += delta
+
+        elif orient == PhysicsSystem.left:
+
+            # translate to the right
+            transform_a.position.x += delta
+            transform_b.position.x -= delta
+
+        elif orient == PhysicsSystem.right:
+
+            # translate to the left
+            transform_a.position.x -= delta
+            transform_b.position.x += delta
+
+        transform_a.mark_changed()
+        transform_b.mark_changed()
+
+    @staticmethod
+    def _resolve_box2box_with_collider(orientation, transform_a, collider_a, collider_b, depth=None):
+
+        # amount that coll_comp_a went into coll_comp_b
+        if depth is None:
+            depth = PhysicsSystem.calc_box_penetration(orientation, collider_a.box, collider_b.box)
+
+        delta = depth * 0.5
+
+        if orientation == PhysicsSystem.top:
+
+            # move coll_comp_a out of coll_comp_b by translating it downwards
+            transform_a.position.y += delta
+
+        elif orientation == PhysicsSystem.bottom:
+
+            # translate upwards
+            transform_a.position.y -= delta
+
+        elif orientation == PhysicsSystem.left:
+
+            # translate to the right
+            transform_a.position.x += delta
+
+        elif orientation == PhysicsSystem.right:
+
+            # translate to the left
+            transform_a.position.x -= delta
+
+        transform_a.mark_changed()
+
+    def _move_body(self, entity):
+        if entity.rigid_body.continuous:
+            self._integrate_continuous_motion(entity)
+        elif entity.uuid in self.substepped:
+            self._integrate_substeps(entity)
+        else:
+            self._integrate_motion(entity.transform, entity.rigid_body)
+
+    # Move the body by a fraction of its motion in this frame. The time step
+    # is the delta time of the engine unless another one is given.
+    def _integrate_motion(self, transform, rigid_body, fraction=1.0, dt=None):
+        # time step
+        if dt is None:
+            dt = self.world.engine.delta_time
+
+        velocity = rigid_body.velocity
+        if velocity.x or velocity.y:
+            transform.position += (fraction * dt) * velocity
+            transform.mark_changed()
+
+        # apply gravity
+        # limit acceleration due to terminal velocity
+        if rigid_body.velocity.sq_magnitude() < self.terminal_speed * self.terminal_speed:
+            rigid_body.velocity += dt * rigid_body.gravity_scale * self.gravity
+
+    # Move a fast body in sub-steps and test it against the entities it may hit after each of them
+    def _integrate_substeps(self, entity):
+
+        contact_manager = self.contact_manager
+
+        substeps = self.substeps
+        dt = self.world.engine.delta_time / substeps
+
+        for i in range(0, substeps):
+
+            self._integrate_motion(entity.transform, entity.rigid_body, dt=dt)
+
+            for other in contact_manager.get_candidates(entity):
+
+                if self._skips_pair(entity, other):
+                    continue
+
+                eA, eB = PhysicsSystem._order_pair(entity, other)
+
+                if PhysicsSystem._narrowphase(eA, eB, self._get_orientation(eA, eB)):
+                    self._add_contact(eA, eB)
+
+    # Move a continuous body up to the first collider its bounds hit along its motion
+    def _integrate_continuous_motion(self, entity):
+
+        transform = entity.transform
+        rigid_body = entity.rigid_body
+
+        dt = self.world.engine.delta_time
+        dx = rigid_body.velocity.x * dt
+        dy = rigid_body.velocity.y * dt
+
+        left, top, right, bottom = entity.collider.get_bounds()
+        half_width = 0.5 * (right - left)
+        half_height = 0.5 * (bottom - top)
+
+        # A body that moves less than half of its size can not skip over anything
+        distance = sqrt(dx * dx + dy * dy)
+        if distance < min(half_width, half_height) or entity.collider.is_trigger:
+            self._integrate_motion(transform, rigid_body)
+            return
+
+        x = 0.5 * (left + right)
+        y = 0.5 * (top + bottom)
+
+        time_of_impact = None
+        hit_entity = None
+        hit_side = None
+
+        for other in self.contact_manager.get_candidates(entity):
+
+            # sweeping the bounds of a tile map would stop the body at its empty tiles
+            if self._skips_pair(entity, other) or other.collider.is_trigger or other.collider.tag == TileCollisionMap.tag:
+                continue
+
+            # circles against circles are swept exactly, everything else as boxes
+            if entity.collider.tag == CircleCollider.tag and other.collider.tag == CircleCollider.tag:
+                position = other.transform.position
+                t = PhysicsSystem.sweep_circle(x, y, dx, dy, position.x, position.y,
+                                               entity.collider.radius + other.collider.radius)
+                side = None
+            else:
+                other_left, other_top, other_right, other_bottom = other.collider.get_bounds()
+                t, side = PhysicsSystem.sweep_bounds(x, y, dx, dy,
+                                                     other_left - half_width, other_top - half_height,
+                                                     other_right + half_width, other_bottom + half_height)
+
+            if t is not None and (time_of_impact is None or t < time_of_impact):
+                time_of_impact = t
+                hit_entity = other
+                hit_side = side
+
+        if time_of_impact is None:
+            self._integrate_motion(transform, rigid_body)
+
+        else:
+            fraction = min(1.0, time_of_impact + self.continuous_depth / distance)
+            self._integrate_motion(transform, rigid_body, fraction)
+
+            if hit_side is not None:
+                self.continuous_hits[ContactManager.get_key(entity, hit_entity)] = (entity, hit_side)
+
+    # The time in [0, 1] at which the point (x, y) moving by (dx, dy) enters the bounds and the side
+    # of the point that hit them, such as PhysicsSystem.right when moving to the right.
+    # (None, None) if it does not enter them during the motion or if it starts inside of them.
+    @staticmethod
+    def sweep_bounds(x, y, dx, dy, left, top, right, bottom):
+
+        t_enter = 0.0
+        t_exit = 1.0
+        side = None
+
+        for p, d, low, high, sides in ((x, dx, left, right, (PhysicsSystem.left, PhysicsSystem.right)),
+                                       (y, dy, top, bottom, (PhysicsSystem.top, PhysicsSystem.bottom))):
+
+            # moving parallel to the slab, it has to be in between its sides
+            if d == 0:
+                if p <= low or p >= high:
+                    return None, None
+                continue
+
+            t_low = (low - p) / d
+            t_high = (high - p) / d
+
+            if t_low > t_high:
+                t_low, t_high = t_high, t_low
+
+            # the slab entered last is the side that was hit
+            if t_low > t_enter:
+                t_enter = t_low
+                side = sides[1] if d > 0 else sides[0]
+
+            t_exit = min(t_exit, t_high)
+
+            if t_enter > t_exit:
+                return None, None
+
+        if t_enter <= 0.0:
+            return None, None
+
+        return t_enter, side
+
+    # The time in [0, 1] at which the point (x, y) moving by (dx, dy) enters the circle
+    # centered at (cx, cy). None if it does not enter it during the motion or if it starts inside of it.
+    @staticmethod
+    def sweep_circle(x, y, dx, dy, cx, cy, radius):
+
+        mx = x - cx
+        my = y - cy
+
+        c = mx * mx + my * my - radius * radius
+        if c <= 0:
+            return None
+
+        a = dx * dx + dy * dy
+        b = 2 * (mx * dx + my * dy)
+
+        discriminant = b * b - 4 * a * c
+        if a == 0 or discriminant < 0:
+            return None
+
+        t = (-b - sqrt(discriminant)) / (2 * a)
+
+        if 0.0 < t <= 1.0:
+            return t
+
+        return None
+
+
+    # ------- spatial queries -------
+    # They search the broadphase and the static index, so only the entities with colliders are found.
+    # The indexes are refreshed by every physics step while the shapes are tested where they are now.
+    # The mask filters the entities by the category of their colliders.
 
-            elif orientation == PhysicsSystem.left or orientation == PhysicsSystem.right:
-                rigid_b.velocity.x *= collider_a.restitution
-                #rigid_a.velocity.y *= collider_b.surface_friction
+    # Return the entities whose collider shapes overlap the (left, top, right, bottom) bounds
+    def query_bounds(self, bounds, mask=Collider.all_layers):
 
-            # Invert velocities according to orientation
-            rigid_b.velocity.x *= x_change
-            rigid_b.velocity.y *= y_change
+        result = list()
 
-        # Collision with another collider only
-        else:
-            PhysicsSystem._resolve_box2box_with_collider(orientation, transform_a, collider_a, collider_b)
+        for e in self._query_indexes(bounds, mask):
 
-            # Invert velocity components depending on which side of the boxes hit
-            rigid_a.velocity.x *= x_change
-            rigid_a.velocity.y *= y_change
+            collider = e.collider
 
-        # This was collider with collider collision. This means that the collider is treated
-        # as a dynamic body that moves and needed collision resolution to be applied.
-        if rigid_a is None:
-            return
+            if collider.tag == CircleCollider.tag:
+                position = e.transform.position
+                if PhysicsSystem._sq_distance_to_bounds(position.x, position.y, bounds) <= collider.radius ** 2:
+                    result.append(e)
 
-        # Apply restitution based on the orientation that the boxes hit
-        # and apply frictional forces between the collider's surfaces
-        if orientation == PhysicsSystem.top or orientation == PhysicsSystem.bottom:
-            rigid_a.velocity.y *= collider_b.restitution
-            rigid_a.velocity.x *= collider_b.surface_friction
+            elif bounds_overlap(collider.get_bounds(), bounds):
+                result.append(e)
 
-        elif orientation == PhysicsSystem.left or orientation == PhysicsSystem.right:
-            rigid_a.velocity.x *= collider_b.restitution
-            #rigid_a.velocity.y *= collider_b.surface_friction
+        return result
 
-        # Zero out velocity components if they are too small in order to avoid
-        # jittery behavior between a moving collider and a static one.
-        if rigid_b is None:
-            if abs(rigid_a.velocity.y) < PhysicsSystem.ignore_velocity_epsilon:
-                if orientation == PhysicsSystem.top or orientation == PhysicsSystem.bottom:
-                    rigid_a.velocity.y = 0
+    # Return the entities whose collider shapes overlap the circle
+    def query_circle(self, x, y, radius, mask=Collider.all_layers):
 
-            if abs(rigid_a.velocity.x) < PhysicsSystem.ignore_velocity_epsilon:
-                if orientation == PhysicsSystem.left or orientation == PhysicsSystem.right:
-                    rigid_a.velocity.x = 0
+        result = list()
 
-    @staticmethod
-    def _resolve_box2box_with_rigid(orient, transform_a, collider_a, transform_b, collider_b):
-        if orient == PhysicsSystem.top:
+        for e in self._query_indexes((x - radius, y - radius, x + radius, y + radius), mask):
 
-            # amount that coll_comp_a went into coll_comp_b
-            delta = collider_b.box.bottom - collider_a.box.top
-            delta *= 0.5
+            collider = e.collider
 
-            # move coll_comp_a out of coll_comp_b by translating it downwards
-            transform_a.position.y += delta
+            if collider.tag == CircleCollider.tag:
+                position = e.transform.position
+                reach = radius + collider.radius
+                if (position.x - x) ** 2 + (position.y - y) ** 2 <= reach * reach:
+                    result.append(e)
 
-            # translate entity_b upwards
-            #transform_b.position.y -= delta
+            elif PhysicsSystem._sq_distance_to_bounds(x, y, collider.get_bounds()) <= radius * radius:
+                result.append(e)
 
-        elif orient == PhysicsSystem.bottom:
-            delta = collider_a.box.bottom - collider_b.box.top
-            delta *= 0.5
+        return result
 
-            # translate upwards
-            transform_a.position.y -= delta
-            #transform_b.position.y += delta
+    # Cast a ray from (x, y) along the unit direction (dx, dy) up to the max distance.
+    # Returns the first entity hit and the distance to it as (entity, distance) or None.
+    # Colliders that contain the start of the ray are ignored.
+    def raycast(self, x, y, dx, dy, max_distance, mask=Collider.all_layers):
 
-        elif orient == PhysicsSystem.left:
-            delta = collider_b.box.right - collider_a.box.left
-            delta *= 0.5
+        dx *= float(max_distance)
+        dy *= float(max_distance)
 
-            # translate to the right
-            transform_a.position.x += delta
-            #transform_b.position.x -= delta
+        closest = None
+        closest_t = None
 
-        elif orient == PhysicsSystem.right:
-            delta = collider_a.box.right - collider_b.box.left
-            delta *= 0.5
+        candidates = self.broadphase.query_segment(x, y, dx, dy) + self.static_index.query_segment(x, y, dx, dy)
 
-            # translate to the left
-            transform_a.position.x -= delta
-            #transform_b.position.x += delta
+        for e in candidates:
 
-    @staticmethod
-    def _resolve_box2box_with_collider(orientation, transform_a, collider_a, collider_b):
-        if orientation == PhysicsSystem.top:
+            if not PhysicsSystem._query_accepts(e, mask):
+                continue
 
-            # amount that coll_comp_a went into coll_comp_b
-            delta = collider_b.box.bottom - collider_a.box.top
-            delta *= 0.5
+            collider = e.collider
 
-            # move coll_comp_a out of coll_comp_b by translating it downwards
-            transform_a.position.y += delta
+            if collider.tag == CircleCollider.tag:
+                position = e.transform.position
+                t = PhysicsSystem.sweep_circle(x, y, dx, dy, position.x, position.y, collider.radius)
+            else:
+                left, top, right, bottom = collider.get_bounds()
+                t = PhysicsSystem.sweep_bounds(x, y, dx, dy, left, top, right, bottom)[0]
 
-        elif orientation == PhysicsSystem.bottom:
-            delta = collider_a.box.bottom - collider_b.box.top
-            delta *= 0.5
+            if t is not None and (closest_t is None or t < closest_t):
+                closest = e
+                closest_t = t
 
-            # translate upwards
-            transform_a.position.y -= delta
+        if closest is None:
+            return None
 
-        elif orientation == PhysicsSystem.left:
-            delta = collider_b.box.right - collider_a.box.left
-            delta *= 0.5
+        return closest, closest_t * max_distance
 
-            # translate to the right
-            transform_a.position.x += delta
+    # Return the entity closest to (x, y), measured to its transform position,
+    # with the tag if one is given. None if there is none within the max distance.
+    def nearest(self, x, y, tag=None, mask=Collider.all_layers, max_distance=None):
 
-        elif orientation == PhysicsSystem.right:
-            delta = collider_a.box.right - collider_b.box.left
-            delta *= 0.5
+        # everything that is indexed, a search that covers it has seen every entity
+        extent = None
+        for index in (self.broadphase, self.static_index):
+            index_extent = index.get_extent()
+            if index_extent is not None:
+                extent = index_extent if extent is None else bounds_union(extent, index_extent)
 
-            # translate to the left
-            transform_a.position.x -= delta
+        if extent is None:
+            return None
 
-    def _integrate_motion(self, transform, rigid_body):
-        # time step
-        dt = self.world.engine.delta_time
+        # search squares that double in size until something is found within the radius
+        radius = float(self.world.cell_size)
+        if max_distance is not None:
+            radius = min(radius, max_distance)
 
-        transform.position += dt * rigid_body.velocity
+        while True:
 
-        # apply gravity
-        # limit acceleration due to terminal velocity
-        if rigid_body.velocity.sq_magnitude() < self.terminal_speed * self.terminal_speed:
-            rigid_body.velocity += dt * rigid_body.gravity_scale * self.gravity
+            bounds = (x - radius, y - radius, x + radius, y + radius)
+
+            closest = None
+            closest_sq_distance = radius * radius
+
+            for e in self._query_indexes(bounds, mask):
+
+                if tag is not None and e.tag != tag:
+                    continue
+
+                position = e.transform.position
+                sq_distance = (position.x - x) ** 2 + (position.y - y) ** 2
+
+                if sq_distance <= closest_sq_distance:
+                    closest = e
+                    closest_sq_distance = sq_distance
+
+            if closest is not None or bounds_contain(bounds, extent):
+                return closest
+
+            if max_distance is not None and radius >= max_distance:
+                return None
+
+            radius *= 2
+            if max_distance is not None:
+                radius = min(radius, max_distance)
+
+    # the enabled entities of the indexes whose bounds overlap the bounds
+    def _query_indexes(self, bounds, mask):
+        candidates = self.broadphase.query(bounds) + self.static_index.query(bounds)
+        return [e for e in candidates if PhysicsSystem._query_accepts(e, mask)]
+
+    @staticmethod
+    def _query_accepts(entity, mask):
+        return not entity.disabled and entity.collider is not None and entity.collider.category & mask
 
+    # the squared distance from the point to the closest point of the bounds
+    @staticmethod
+    def _sq_distance_to_bounds(x, y, bounds):
+        dx = max(bounds[0] - x, 0, x - bounds[2])
+        dy = max(bounds[1] - y, 0, y - bounds[3])
+        return dx * dx + dy * dy
 
 # Requires for an entity to have a render and transform component
 # Holds the surface to render images
@@ -604,6 +1932,32 @@ class RenderSystem (System):
 
     tag = "render system"
 
+    # the ways of drawing many sprites with one call that the version of pygame has
+    _has_fblits = hasattr(pygame.Surface, "fblits")
+    _has_blits = hasattr(pygame.Surface, "blits")
+
+    # The part of the world that the camera shows in this frame. Its top left corner is the
+    # position of the camera and its size the one of the camera follow script of the camera,
+    # or the size of the display if it has none.
+    class Viewport(object):
+
+        def __init__(self):
+            self.x = 0.0
+            self.y = 0.0
+            self.width = 0
+            self.height = 0
+            self.rect = Rect(0, 0, 0, 0)
+
+        def set(self, x, y, width, height):
+            self.x = x
+            self.y = y
+            self.width = width
+            self.height = height
+            self.rect = Rect(x, y, width, height)
+
+        def get_bounds(self):
+            return self.x, self.y, self.x + self.width, self.y + self.height
+
     def __init__(self):
         super(RenderSystem, self).__init__()
 
@@ -628,6 +1982,47 @@ class RenderSystem (System):
         # in a dark environment.
         self.simulate_dark_env = False
 
+        # Fraction between the previous and current fixed steps to draw the entities at.
+        # None draws the current positions.
+        self.interpolation_alpha = None
+
+        # Only redraw and update the parts of the screen that changed since the last frame instead of the whole
+        # screen. Suits scenes where most of the sprites stay still. The background color is drawn under the
+        # sprites, a background image can be drawn by a renderer in the deepest layer.
+        self.dirty_rects = False
+        self.background_color = (0, 0, 0)
+
+        # The rects of the display to update this frame. None updates the whole display.
+        self.updated_rects = None
+
+        # the state of the sprites and of the camera drawn on the last frame
+        self._drawn = None
+        self._drawn_camera_position = None
+
+        # Updated once per frame when there is a camera
+        self.viewport = RenderSystem.Viewport()
+
+        # The renderers that stay still are indexed by their bounds in a grid of cells of this size per layer,
+        # so the camera only visits the renderers in the cells it shows. The ones that move are checked every frame.
+        self.cell_size = 256
+
+        # maps the layers to the grids, which map the (column, row) of the cells to the (order, renderer) in them
+        self.still_cells = dict()
+
+        # maps the layers to the (order, renderer) that move
+        self.moving_renderers = dict()
+
+        # maps the renderers to their (order, layer). The order is the order of the renderers in their layer.
+        self.render_entries = dict()
+
+        # maps the still renderers to the cells they are in
+        self.indexed_cells = dict()
+
+        # the renderers that were added or changed since the last frame
+        self.changed_renderers = list()
+
+        self._render_order = 0
+
     # for utility to create a solid image surface of some color
     @staticmethod
     def create_solid_image(width, height, color):
@@ -668,6 +2063,16 @@ class RenderSystem (System):
         # have the greater values be rendered first (z-coordinate simulation)
         self.ordered_layers.reverse()
 
+        # index the renderers in the order of their layers
+        self.still_cells.clear()
+        self.moving_renderers.clear()
+        self.render_entries.clear()
+        self.indexed_cells.clear()
+
+        for layer in self.scene:
+            for renderer in self.scene[layer]:
+                self._add_renderer(renderer, layer)
+
     # Add a new entity to the scene.
     # Use this during the run time of the game
     def dynamic_insertion_to_scene(self, entity):
@@ -675,6 +2080,8 @@ class RenderSystem (System):
         if renderer is not None:
             depth = renderer.depth
 
+            self._add_renderer(renderer, depth)
+
             # layer already exists
             if depth in self.scene:
                 self.scene[depth].append(renderer)
@@ -729,6 +2136,8 @@ class RenderSystem (System):
         renderer = entity.renderer
         if renderer is not None:
 
+            self._remove_renderer(renderer)
+
             depth = renderer.depth
 
             # check that it exists in the scene
@@ -745,80 +2154,210 @@ class RenderSystem (System):
 
                     i += 1
 
-    def render_scene(self):
+    # Index an entity again after its components or scripts changed
+    def entity_changed(self, entity):
+        renderer = entity.renderer
+        if renderer is not None and renderer in self.render_entries:
+            self.changed_renderers.append(renderer)
+
+    # Move a renderer that stays still to the cells of its new position on the next frame. Called whenever
+    # the version of the transform of its entity goes up. The render system checks the transforms of the
+    # still renderers it visits and the physics system the ones of the colliders, so call mark_changed()
+    # after moving a still renderer without a collider from outside of the view.
+    def transform_changed(self, entity):
+        renderer = entity.renderer
+        if renderer in self.indexed_cells:
+            self.changed_renderers.append(renderer)
 
-        # paint the screen black to setup the dark environment
-        if self.simulate_dark_env:
-            self.world.engine.display.fill((0, 0, 0))
+    # A renderer stays still unless a rigid body or scripts may move it, an animator may change
+    # the size of its sprite or it stays on the screen while the camera moves.
+    @staticmethod
+    def is_still(renderer):
+        entity = renderer.entity
+        return entity.transform is not None and entity.rigid_body is None and entity.animator is None and \
+            not entity.scripts and not renderer.is_static
 
-        # Iterate through each layer in the scene in order
-        for layer in self.ordered_layers:
+    # The renderer is indexed on the next frame, once the components of its entity are set up
+    def _add_renderer(self, renderer, layer):
 
-            for renderer in self.scene[layer]:
+        if renderer in self.render_entries:
+            self._unindex_renderer(renderer)
 
-                # access the transform
-                entity = renderer.entity
-                if entity.disabled:
-                    continue
+        self.render_entries[renderer] = (self._render_order, layer)
+        self._render_order += 1
 
-                transform = entity.transform
+        self.changed_renderers.append(renderer)
 
-                # transform exists
+    def _remove_renderer(self, renderer):
+        if renderer in self.render_entries:
+            self._unindex_renderer(renderer)
+            del self.render_entries[renderer]
+
+    def _index_renderer(self, renderer):
+
+        order, layer = self.render_entries[renderer]
+        entry = (order, renderer)
+
+        if not RenderSystem.is_still(renderer):
+            self.moving_renderers.setdefault(layer, []).append(entry)
+            return
+
+        transform = renderer.entity.transform
+
+        # it is drawn where it is from now on
+        transform.previous_position = None
+
+        left = transform.position.x - renderer.pivot.x
+        top = transform.position.y - renderer.pivot.y
+        right = left + renderer.sprite.get_width()
+        bottom = top + renderer.sprite.get_height()
+
+        grid = self.still_cells.setdefault(layer, dict())
+        cells = RenderSystem._get_cells((left, top, right, bottom), self.cell_size)
+
+        for cell in cells:
+            grid.setdefault(cell, []).append(entry)
+
+        self.indexed_cells[renderer] = cells
+
+    def _unindex_renderer(self, renderer):
+
+        order, layer = self.render_entries[renderer]
+        entry = (order, renderer)
+
+        cells = self.indexed_cells.pop(renderer, None)
+
+        if cells is None:
+            moving = self.moving_renderers.get(layer)
+            if moving is not None and entry in moving:
+                moving.remove(entry)
+            return
+
+        grid = self.still_cells[layer]
+        for cell in cells:
+            grid[cell].remove(entry)
+
+            if not grid[cell]:
+                del grid[cell]
+
+    def _update_render_index(self):
+
+        for renderer in self.changed_renderers:
+
+            # removed from the scene after it changed
+            if renderer not in self.render_entries:
+                continue
+
+            self._unindex_renderer(renderer)
+            self._index_renderer(renderer)
+
+        del self.changed_renderers[:]
+
+    # The (column, row) of the cells that the bounds cover
+    @staticmethod
+    def _get_cells(bounds, cell_size):
+
+        first_column = int(floor(bounds[0] / cell_size))
+        first_row = int(floor(bounds[1] / cell_size))
+        last_column = int(floor(bounds[2] / cell_size))
+        last_row = int(floor(bounds[3] / cell_size))
+
+        return [(column, row) for column in range(first_column, last_column + 1)
+                for row in range(first_row, last_row + 1)]
+
+    # The renderers of the layer that may be in the viewport, in their order in the layer
+    def _get_visible_renderers(self, layer, cells):
+
+        found = dict()
+
+        grid = self.still_cells.get(layer)
+        if grid:
+            for cell in cells:
+                for order, renderer in grid.get(cell, ()):
+                    if order not in found:
+                        found[order] = renderer
+
+                        # Scripts move the transforms directly, so check the ones that are visited.
+                        # One that moved is put in the cells of its new position on the next frame.
+                        renderer.entity.transform.check_changed()
+
+        for order, renderer in self.moving_renderers.get(layer, ()):
+            found[order] = renderer
+
+        return [found[order] for order in sorted(found)]
+
+    def _update_viewport(self):
+
+        camera = self.camera
+        x, y = self.get_render_xy(camera.transform)
+
+        follow = camera.get_script("camera follow")
+        if follow is not None:
+            self.viewport.set(x, y, follow.width, follow.height)
+        else:
+            width, height = self.world.engine.display.get_size()
+            self.viewport.set(x, y, width, height)
+
+    # Save the positions of the rendered entities and the camera before a fixed step.
+    # The renderers that stay still are left out.
+    def save_previous_positions(self):
+
+        if self.changed_renderers:
+            self._update_render_index()
+
+        for moving in self.moving_renderers.values():
+            for order, renderer in moving:
+                transform = renderer.entity.transform
                 if transform is not None:
+                    transform.previous_position = transform.position.to_tuple()
 
-                    # Center it around the image pivot
-                    position = transform.position - renderer.pivot
+        if self.camera is not None:
+            self.camera.transform.previous_position = self.camera.transform.position.to_tuple()
 
-                    # Offset image position with the camera if the renderer is not static
-                    if self.camera is not None and not renderer.is_static:
+    # The position to draw the transform at
+    def get_render_position(self, transform):
+        alpha = self.interpolation_alpha
+        previous = transform.previous_position
 
-                        position -= self.camera.transform.position
+        if alpha is None or previous is None:
+            return transform.position
 
-                        render_rect = renderer.sprite.get_rect().copy()
+        x, y = self.get_render_xy(transform)
+        return Vector2(x, y)
 
-                        # center the rect around its transform
-                        render_rect.topleft = (position.x, position.y)
+    # The position to draw the transform at as an (x, y) tuple, without creating a vector
+    def get_render_xy(self, transform):
+        alpha = self.interpolation_alpha
+        previous = transform.previous_position
+        position = transform.position
 
-                        # obtain camera data, topleft corner coordinates, width, and height
-                        cx = self.camera.transform.position.x
-                        cy = self.camera.transform.position.y
+        if alpha is None or previous is None:
+            return position.x, position.y
 
-                        # FIX, have width and height be a permanent location for the engine
-                        # such as having it as variables for the camera object.
-                        cw = self.camera.get_script("camera follow").width
-                        ch = self.camera.get_script("camera follow").height
+        return previous[0] + (position.x - previous[0]) * alpha, previous[1] + (position.y - previous[1]) * alpha
 
-                        camera_rect = Rect(cx, cy, cw, ch)
+    def render_scene(self):
 
-                        # adjust with camera movement
-                        render_rect.x += cx
-                        render_rect.y += cy
+        display = self.world.engine.display
 
-                        # if the sprite rect is colliding with the camera's rect
-                        # then blit
-                        if camera_rect.colliderect(render_rect):
-                            # render to the buffer first if we want to simulate a dark environment
-                            if self.simulate_dark_env:
-                                self.blit_buffer.blit(renderer.sprite, (position.x, position.y))
+        # paint the screen black to setup the dark environment
+        if self.simulate_dark_env:
+            display.fill((0, 0, 0))
 
-                            # render to the screen
-                            else:
-                                display = self.world.engine.display
-                                display.blit(renderer.sprite, (position.x, position.y))
+        layers = self._collect_sprites()
 
-                    # if there is no camera just blit directly to the buffer
-                    else:
-                        # render to the buffer first if we want to simulate a dark environment
-                        if self.simulate_dark_env:
-                            self.blit_buffer.blit(renderer.sprite, (position.x, position.y))
+        # the dark environment and the debug info are drawn over the whole screen
+        if self.dirty_rects and not self.simulate_dark_env and not self.world.engine.debug:
+            self._draw_dirty(layers)
 
-                        # render to the screen
-                        else:
-                            display = self.world.engine.display
-                            display.blit(renderer.sprite, (position.x, position.y))
+        else:
+            self.redraw()
 
-                else:
-                    print("Renderer has no transform associated.")
+            # render to the buffer first if we want to simulate a dark environment
+            target = self.blit_buffer if self.simulate_dark_env else display
+
+            for entities, sprites in layers:
+                RenderSystem.blit_sprites(target, sprites)
 
         # to simulate light sources in dark environments
         if self.simulate_dark_env:
@@ -826,18 +2365,13 @@ class RenderSystem (System):
             for light_source in self.light_sources:
 
                 # obtain camera data, topleft corner coordinates, width, and height
-                cx = self.camera.transform.position.x
-                cy = self.camera.transform.position.y
-
-                # FIX, have width and height be a permanent location for the engine
-                # such as having it as variables for the camera object.
-                cw = self.camera.get_script("camera follow").width
-                ch = self.camera.get_script("camera follow").height
-
-                camera_rect = Rect(cx, cy, cw, ch)
+                cx = self.viewport.x
+                cy = self.viewport.y
+                camera_rect = self.viewport.rect
 
-                x = light_source.transform.position.x
-                y = light_source.transform.position.y
+                light_position = self.get_render_position(light_source.transform)
+                x = light_position.x
+                y = light_position.y
 
                 light_rect = light_source.renderer.sprite.get_rect().copy()
 
@@ -858,9 +2392,211 @@ class RenderSystem (System):
                     tmp.blit(self.blit_buffer, (-x, -y), special_flags=pygame.BLEND_RGBA_MIN)
                     self.world.engine.display.blit(tmp, (x, y))
 
+    # The sprites to draw for each layer in order, as an (entities, sprites) pair per layer where the sprites
+    # are the (sprite, (x, y)) pairs to blit at their positions on the screen, ready for Surface.blits.
+    # With a camera only the renderers in the cells of the viewport and the ones that move are visited.
+    def _collect_sprites(self):
+
+        if self.changed_renderers:
+            self._update_render_index()
+
+        layers = list()
+
+        camera = self.camera
+        if camera is not None:
+            self._update_viewport()
+
+            cx = self.viewport.x
+            cy = self.viewport.y
+            camera_rect = self.viewport.rect
+            cells = RenderSystem._get_cells(self.viewport.get_bounds(), self.cell_size)
+
+        # Iterate through each layer in the scene in order
+        for layer in self.ordered_layers:
+
+            if camera is None:
+                renderers = self.scene[layer]
+            else:
+                renderers = self._get_visible_renderers(layer, cells)
+
+            entities = list()
+            sprites = list()
+
+            for renderer in renderers:
+
+                # access the transform
+                entity = renderer.entity
+                if entity.disabled:
+                    continue
+
+                transform = entity.transform
+
+                # transform exists
+                if transform is not None:
+
+                    # Center it around the image pivot
+                    x, y = self.get_render_xy(transform)
+                    x -= renderer.pivot.x
+                    y -= renderer.pivot.y
+
+                    sprite = renderer.sprite
+
+                    # Offset image position with the camera if the renderer is not static
+                    if camera is not None and not renderer.is_static:
+
+                        # if the sprite rect is not colliding with the camera's rect then skip it
+                        if not camera_rect.colliderect((x, y, sprite.get_width(), sprite.get_height())):
+                            continue
+
+                        x -= cx
+                        y -= cy
+
+                    entities.append(entity)
+                    sprites.append((sprite, (x, y)))
+
+                else:
+                    print("Renderer has no transform associated.")
+
+            if sprites:
+                layers.append((entities, sprites))
+
+        return layers
+
+    # Draw the (sprite, position) pairs with a single call. Surface.fblits skips building the list of
+    # rects that Surface.blits returns, Surface.blits needs pygame 1.9.4.
+    @staticmethod
+    def blit_sprites(target, sprites):
+
+        if RenderSystem._has_fblits:
+            target.fblits(sprites)
+
+        elif RenderSystem._has_blits:
+            target.blits(sprites, 0)
+
+        else:
+            for sprite, position in sprites:
+                target.blit(sprite, position)
+
+    # Only redraw the parts of the screen that changed since the last frame. The rects of the sprites drawn
+    # last frame are compared to the ones of this frame, and the ones of the sprites that moved, changed or
+    # went away are merged into the dirty rects. The background is restored under the dirty rects, the sprites
+    # that overlap them are drawn again clipped to them and only the dirty rects are updated on the display.
+    # Everything moves on the screen when the camera moves, so the whole screen is redrawn then.
+    def _draw_dirty(self, layers):
+
+        display = self.world.engine.display
+        screen = display.get_rect()
+
+        camera_position = None
+        if self.camera is not None:
+            camera_position = self.get_render_xy(self.camera.transform)
+
+        # the sprites and their rects in drawing order and the state of each one that is compared to the last frame
+        sprites = list()
+        rects = list()
+        drawn = dict()
+
+        for layer_entities, layer_sprites in layers:
+            sprites.extend(layer_sprites)
+
+            for i in range(0, len(layer_sprites)):
+                entity = layer_entities[i]
+                sprite, (x, y) = layer_sprites[i]
+
+                rect = Rect(x, y, sprite.get_width(), sprite.get_height())
+                rects.append(rect)
+                drawn[entity.uuid] = (rect, sprite, entity.renderer.version)
+
+        # the gui is drawn over the scene after it, but the scene has to be restored under the widgets that changed
+        for widget in self.world.engine.gui.widgets:
+            rect = Rect(widget.position.x, widget.position.y, widget.image.get_width(), widget.image.get_height())
+            drawn[("gui", widget.uuid)] = (rect, widget.image, 0)
+
+        previous = self._drawn
+        self._drawn = drawn
+
+        if previous is None or camera_position != self._drawn_camera_position:
+            self._drawn_camera_position = camera_position
+            self.updated_rects = None
+
+            display.fill(self.background_color)
+            RenderSystem.blit_sprites(display, sprites)
+            return
+
+        dirty = list()
+
+        for key, state in drawn.items():
+            last = previous.get(key)
+
+            if last is None:
+                dirty.append(state[0])
+
+            elif last != state:
+                dirty.append(last[0])
+                dirty.append(state[0])
+
+        for key, last in previous.items():
+            if key not in drawn:
+                dirty.append(last[0])
+
+        dirty = RenderSystem.merge_rects([rect.clip(screen) for rect in dirty])
+
+        for rect in dirty:
+            display.set_clip(rect)
+            display.fill(self.background_color, rect)
+
+            # the sprites that overlap the rect, in drawing order
+            RenderSystem.blit_sprites(display, [sprites[i] for i in rect.collidelistall(rects)])
+
+        display.set_clip(None)
+
+        self.updated_rects = dirty
+
+    # Draw the whole screen on the next frame. Call it after drawing on the display or on
+    # a sprite directly when the dirty rects are used, since those changes are not tracked.
+    def redraw(self):
+        self._drawn = None
+        self.updated_rects = None
+
+    # Merge the overlapping rects into the rects that bound them. Empty rects are dropped.
+    @staticmethod
+    def merge_rects(rects):
+
+        merged = list()
+
+        for rect in rects:
+            if rect.w <= 0 or rect.h <= 0:
+                continue
+
+            # keep growing the rect until it overlaps none of the merged rects
+            i = rect.collidelist(merged)
+            while i >= 0:
+                rect = rect.union(merged.pop(i))
+                i = rect.collidelist(merged)
+
+            merged.append(rect)
+
+        return merged
+
     def process(self, entities):
         self.render_scene()
 
+        engine = self.world.engine
+
+        # In the deterministic mode of the engine the animations advance with the ticks instead, see World.step().
+        # Only the renderers that move can have an animator, see is_still(), so the rest are left out.
+        if not engine.deterministic:
+            self.update_animations([renderer.entity for moving in self.moving_renderers.values()
+                                    for order, renderer in moving], engine.delta_time)
+
+        if engine.debug:
+            for e in entities:
+                if not e.disabled:
+                    self.debug(e)
+
+    # Advance the animators of the entities by the elapsed time: seconds, or ticks in the deterministic mode of the engine
+    @staticmethod
+    def update_animations(entities, elapsed):
         for e in entities:
 
             if e.disabled:
@@ -869,10 +2605,7 @@ class RenderSystem (System):
             # update the animation for an entity if possible
             animator = e.animator
             if animator is not None:
-                animator._update_animation()
-
-            if self.world.engine.debug:
-                    self.debug(e)
+                animator._update_animation(elapsed)
 
     def debug(self, e):
 
@@ -948,7 +2681,7 @@ class RenderSystem (System):
             if collider.tag == BoxCollider.tag:
 
                 # get relative position to transform
-                get_relative_rect_pos(transform.position, collider)
+                collider.place_box()
 
                 # center the box image
                 x -= collider.box.width/2
@@ -975,3 +2708,13 @@ class RenderSystem (System):
             elif collider.tag == CircleCollider.tag:
                 radius = collider.radius
                 pygame.draw.circle(display, (255, 255, 255), (int(x), int(y)), radius, 1)
+
+            elif collider.tag == PolygonCollider.tag:
+
+                # shift the world space vertices like the position
+                x_shift = x - transform.position.x
+                y_shift = y - transform.position.y
+                points = [(vx + x_shift, vy + y_shift) for vx, vy in collider.get_world_vertices()]
+
+                if len(points) > 2:
+                    pygame.draw.polygon(display, (255, 255, 255), points, 1)
@@ -2,6 +2,7 @@ from math import sqrt
 from math import acos
 from math import sin
 from math import cos
+from math import floor
 
 # Two dimensional vector that supports the basic operations
 # such addition of vectors, scalar multiplication, dot product,
@@ -127,6 +128,13 @@ class Vector2:
     def is_zero(self):
         return self.x == 0 and self.y == 0
 
+    # Round the components to the nearest multiple of 1 / scale, halves away from negative infinity.
+    # With a power of two scale the rounded components are exact, so they can be saved, loaded
+    # and compared without any error. Used by the deterministic mode of the physics system.
+    def to_fixed_point(self, scale):
+        self.x = floor(self.x * scale + 0.5) / scale
+        self.y = floor(self.y * scale + 0.5) / scale
+
     def __str__(self):
         return "<" + str(self.x) + ", " + str(self.y) + ">"
 
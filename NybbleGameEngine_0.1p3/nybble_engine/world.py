@@ -1,4 +1,7 @@
 
+import hashlib
+import struct
+
 from managers import EntityManager
 from entity import *
 from systems import *
@@ -30,6 +33,15 @@ class World (object):
         self.height = -1
         self.origin = Vector2(0, 0)
 
+        # Width and height of a cell of the spatial hash used by the physics broadphase.
+        # It should be around the size of the common moving objects of the world.
+        self.cell_size = 128
+
+        # The layer collision matrix. Holds for each of the 32 collision layers the bits
+        # of the layers it collides with. Every layer collides with every other by default.
+        self.layer_matrix = [Collider.all_layers] * 32
+        self.all_layers_collide = True
+
         self.loading_scene = False
 
     # this function is a wrapper that is used to detect if we are loading the scene of the world
@@ -41,6 +53,11 @@ class World (object):
 
         self.loading_scene = False
 
+        # index the colliders that never move now that the scene is set up
+        physics_system = self.get_system(PhysicsSystem.tag)
+        if physics_system is not None:
+            physics_system.bake_static_colliders(self.entity_manager.entities)
+
     @abstractmethod
     def load_scene(self):
         """
@@ -85,6 +102,20 @@ class World (object):
         if not self.loading_scene:
             self.get_system(RenderSystem.tag).dynamic_insertion_to_scene(entity)
 
+        self._colliders_changed(entity)
+
+        return entity
+
+    # A game object whose collider only collides where the image is opaque
+    def create_mask_collider_object(self, image_surface):
+        entity = MaskColliderObject(image_surface)
+        entity.world = self
+        self.entity_manager.add(entity)
+
+        if not self.loading_scene:
+            self.get_system(RenderSystem.tag).dynamic_insertion_to_scene(entity)
+
+        self._colliders_changed(entity)
         return entity
 
     def create_renderable_object(self, image_surface, pivot=None):
@@ -101,12 +132,29 @@ class World (object):
         entity = BoxColliderObject(width, height)
         entity.world = self
         self.entity_manager.add(entity)
+        self._colliders_changed(entity)
         return entity
 
     def create_circle_collider_object(self, radius):
         entity = CircleColliderObject(radius)
         entity.world = self
         self.entity_manager.add(entity)
+        self._colliders_changed(entity)
+        return entity
+
+    # The vertices are (x, y) tuples relative to the position of the entity, in order around a convex polygon
+    def create_polygon_collider_object(self, vertices):
+        entity = PolygonColliderObject(vertices)
+        entity.world = self
+        self.entity_manager.add(entity)
+        self._colliders_changed(entity)
+        return entity
+
+    def create_tile_map_object(self, columns, rows, tile_width, tile_height):
+        entity = TileMapObject(columns, rows, tile_width, tile_height)
+        entity.world = self
+        self.entity_manager.add(entity)
+        self._colliders_changed(entity)
         return entity
 
     def destroy_entity(self, entity):
@@ -115,8 +163,92 @@ class World (object):
         render_system = self.get_system(RenderSystem.tag)
         render_system.remove_from_scene(entity)
 
+        # remove the entity from the physics indexes
+        physics_system = self.get_system(PhysicsSystem.tag)
+        if physics_system is not None:
+            physics_system.entity_removed(entity)
+
         self.entity_manager.remove_entity(entity)
 
+    # Let the render system know that the transform of an entity changed
+    def _transform_changed(self, entity):
+        render_system = self.get_system(RenderSystem.tag)
+        if render_system is not None:
+            render_system.transform_changed(entity)
+
+    # Let the physics and render systems know that the components or scripts of an entity changed.
+    # Everything created while loading the scene is indexed once the loading is done.
+    def _colliders_changed(self, entity):
+        if self.loading_scene:
+            return
+
+        physics_system = self.get_system(PhysicsSystem.tag)
+        if physics_system is not None:
+            physics_system.entity_changed(entity)
+
+        render_system = self.get_system(RenderSystem.tag)
+        if render_system is not None:
+            render_system.entity_changed(entity)
+
+    # Let the colliders of two layers collide with each other or not
+    def set_layer_collision(self, layer_a, layer_b, collide):
+
+        if collide:
+            self.layer_matrix[layer_a] |= 1 << layer_b
+            self.layer_matrix[layer_b] |= 1 << layer_a
+        else:
+            self.layer_matrix[layer_a] &= ~(1 << layer_b)
+            self.layer_matrix[layer_b] &= ~(1 << layer_a)
+
+        self.all_layers_collide = True
+        for row in self.layer_matrix:
+            if row & Collider.all_layers != Collider.all_layers:
+                self.all_layers_collide = False
+
+    # Tell if any layer of category a collides with any layer of category b
+    # according to the layer collision matrix
+    def layers_collide(self, category_a, category_b):
+
+        if self.all_layers_collide:
+            return True
+
+        layer = 0
+        while category_a:
+
+            if category_a & 1 and self.layer_matrix[layer] & category_b:
+                return True
+
+            category_a >>= 1
+            layer += 1
+
+        return False
+
+    # ------- spatial queries -------
+    # Searches the colliders indexed by the physics system, see PhysicsSystem.query_bounds().
+    # The mask selects the collision layers to search.
+
+    # Cast a ray from the origin along the direction. Returns the first entity hit
+    # and the distance to it as (entity, distance), or None if nothing was hit.
+    def raycast(self, origin, direction, max_distance, mask=Collider.all_layers):
+        if direction.is_zero():
+            return None
+
+        normal = Vector2.get_normal(direction)
+        physics_system = self.get_system(PhysicsSystem.tag)
+        return physics_system.raycast(origin.x, origin.y, normal.x, normal.y, max_distance, mask)
+
+    # Return the entities whose colliders overlap the axis aligned box
+    def query_aabb(self, left, top, right, bottom, mask=Collider.all_layers):
+        return self.get_system(PhysicsSystem.tag).query_bounds((left, top, right, bottom), mask)
+
+    # Return the entities whose colliders overlap the circle
+    def query_circle(self, center, radius, mask=Collider.all_layers):
+        return self.get_system(PhysicsSystem.tag).query_circle(center.x, center.y, radius, mask)
+
+    # Return the entity closest to the position, optionally with the given tag
+    def nearest(self, position, tag=None, mask=Collider.all_layers, max_distance=None):
+        return self.get_system(PhysicsSystem.tag).nearest(position.x, position.y, tag, mask, max_distance)
+
     def add_system(self, system):
         system.world = self
 
@@ -152,11 +284,42 @@ class World (object):
             i += 1
         return None
 
+    # Advance the simulation by one fixed step: every system except the render system
+    # followed by the scripts. Used by the fixed timestep mode of the engine.
+    def step(self):
+        render_system = self.get_system(RenderSystem.tag)
+
+        # remember where everything was drawn to interpolate from
+        if render_system is not None:
+            render_system.save_previous_positions()
+
+        for s in self.systems:
+            if s is not render_system:
+                s.process(self.entity_manager.entities)
+
+        self._update_scripts()
+
+        # in the deterministic mode the animations advance one tick at a time along with the simulation,
+        # so they land on the same ticks however many ticks each render covers
+        if self.engine.deterministic:
+            RenderSystem.update_animations(self.entity_manager.entities, 1)
+
+    # Draw the world. The interpolation alpha is the fraction of the time between
+    # the previous and the current step to draw the entities at.
+    def render(self, interpolation_alpha=None):
+        render_system = self.get_system(RenderSystem.tag)
+        render_system.interpolation_alpha = interpolation_alpha
+        render_system.process(self.entity_manager.entities)
+
     # Have each system process the entities
     def run(self):
         for s in self.systems:
             s.process(self.entity_manager.entities)
 
+        self._update_scripts()
+
+    def _update_scripts(self):
+
         # Run script updates - Reverse iteration to handle removals of entities.
         for i in xrange(len(self.entity_manager.entities) - 1, -1, -1):
             e = self.entity_manager.entities[i]
@@ -168,6 +331,31 @@ class World (object):
             s = self.scripts[i]
             s.update()
 
+    # A hash of the simulation state: the tick of the engine along with the positions, velocities
+    # and animation frames of the entities. In the deterministic mode of the engine, runs with
+    # the same inputs give the same hash on the same tick, so runs can be compared by hash.
+    def get_state_hash(self):
+
+        state = hashlib.sha1()
+        state.update(struct.pack('<q', self.engine.tick))
+
+        for e in self.entity_manager.entities:
+
+            state.update(struct.pack('<q', e.uuid))
+
+            if e.transform is not None:
+                position = e.transform.position
+                state.update(struct.pack('<dd', position.x, position.y))
+
+            if e.rigid_body is not None:
+                velocity = e.rigid_body.velocity
+                state.update(struct.pack('<dd', velocity.x, velocity.y))
+
+            if e.animator is not None:
+                state.update(struct.pack('<qd', e.animator.current_frame_index, e.animator.latency_accumulator))
+
+        return state.hexdigest()
+
     # determine if the world has bounds
     def is_bounded(self):
         return self.width > 0 and self.height > 0
\ No newline at end of file
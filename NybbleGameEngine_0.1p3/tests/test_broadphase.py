@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+from random import Random
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "nybble_engine"))
+
+from world import *
+from engine import *
+from broadphase import SweepAndPruneBroadphase, bounds_overlap
+
+
+class RandomBoxesWorld(World):
+
+    def load_scene(self):
+
+        rnd = Random(3)
+
+        for i in range(500):
+            e = self.create_box_collider_object(rnd.randint(2, 60), rnd.randint(2, 60))
+            e.transform.position = Vector2(rnd.uniform(0, 4000), rnd.uniform(0, 1000))
+
+        # a box longer than the others so the query has to look far back along the axis
+        floor = self.create_box_collider_object(3000, 20)
+        floor.transform.position = Vector2(2000, 500)
+
+
+class SweepAndPruneQueryTest(unittest.TestCase):
+
+    def test_query_matches_brute_force(self):
+
+        engine = Engine(600, 400)
+        world = RandomBoxesWorld()
+        engine.set_world(world)
+        world.engine = engine
+        world.start_scene_loading()
+
+        entities = world.entity_manager.entities
+
+        broadphase = SweepAndPruneBroadphase()
+        broadphase.world = world
+        broadphase.update(entities)
+
+        rnd = Random(1)
+        for i in range(200):
+            x = rnd.uniform(-100, 4100)
+            y = rnd.uniform(-100, 1100)
+            bounds = (x, y, x + rnd.uniform(0, 300), y + rnd.uniform(0, 300))
+
+            expected = sorted(e.uuid for e in entities if bounds_overlap(e.collider.get_bounds(), bounds))
+            self.assertEqual(expected, sorted(e.uuid for e in broadphase.query(bounds)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import unittest
+from random import Random
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "nybble_engine"))
+
+from world import *
+from engine import *
+from numpy_physics import ParallelBroadphase
+
+
+class CrowdedWorld(World):
+
+    def load_scene(self):
+
+        self.width = 1600
+        self.height = 1200
+
+        # the same scene every run
+        rnd = Random(5)
+
+        for i in range(600):
+
+            if rnd.random() < 0.5:
+                e = self.create_box_collider_object(rnd.randint(5, 40), rnd.randint(5, 40))
+            else:
+                e = self.create_circle_collider_object(rnd.randint(3, 20))
+
+            e.transform.position = Vector2(rnd.uniform(0, self.width), rnd.uniform(0, self.height))
+
+            # leave some of the boxes static, the circle response needs both circles to have rigid bodies
+            if rnd.random() < 0.7 or e.collider.tag == CircleCollider.tag:
+                e.add_component(RigidBody(Vector2(rnd.uniform(-300, 300), rnd.uniform(-300, 300))))
+                e.rigid_body.gravity_scale = 1.0
+
+
+# Step the scene with the broadphase. Returns the contacts of each frame as
+# sorted uuid pairs and the final positions and velocities of the entities.
+def run(broadphase, frames):
+
+    engine = Engine(600, 400)
+    world = CrowdedWorld()
+    engine.set_world(world)
+    world.engine = engine
+
+    physics = world.get_system(PhysicsSystem.tag)
+    if broadphase is not None:
+        physics.broadphase = broadphase
+
+    world.start_scene_loading()
+    engine.delta_time = 1.0 / 60.0
+
+    contacts = list()
+    for i in range(frames):
+        physics.process(world.entity_manager.entities)
+        contacts.append(sorted(tuple(sorted((eA.uuid, eB.uuid))) for eA, eB in physics.collision_queue))
+
+    states = list()
+    for e in world.entity_manager.entities:
+        state = [e.uuid, e.transform.position.x, e.transform.position.y]
+        if e.rigid_body is not None:
+            state += [e.rigid_body.velocity.x, e.rigid_body.velocity.y]
+        states.append(state)
+
+    return contacts, states
+
+
+class ParallelBroadphaseTest(unittest.TestCase):
+
+    frames = 30
+
+    @classmethod
+    def setUpClass(cls):
+        cls.serial = run(None, cls.frames)
+
+    def check_same_as_serial(self, broadphase):
+        try:
+            contacts, states = run(broadphase, self.frames)
+        finally:
+            broadphase.close()
+
+        self.assertTrue(any(self.serial[0]))
+        self.assertEqual(self.serial[0], contacts)
+        self.assertEqual(self.serial[1], states)
+
+    def test_single_strip(self):
+        self.check_same_as_serial(ParallelBroadphase(processes=1, strips=1))
+
+    def test_strips(self):
+        self.check_same_as_serial(ParallelBroadphase(processes=1, strips=7))
+
+    def test_worker_processes(self):
+        self.check_same_as_serial(ParallelBroadphase(processes=2, strips=5, min_colliders=0))
+
+
+if __name__ == "__main__":
+    unittest.main()
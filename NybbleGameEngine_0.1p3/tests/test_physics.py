@@ -0,0 +1,242 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "nybble_engine"))
+
+from world import *
+from engine import *
+from components import BehaviorScript
+from numpy_physics import BatchNarrowphase
+
+
+# Destroys the bricks it hits, like the BallBehavior of the breakout driver
+class DestroyBricks(BehaviorScript):
+
+    def __init__(self):
+        super(DestroyBricks, self).__init__("destroy bricks")
+
+    def collision_event(self, other_collider):
+        if other_collider.entity.tag == "brick":
+            self.entity.world.destroy_entity(other_collider.entity)
+
+
+class TwoBallsWorld(World):
+
+    def __init__(self, speed):
+        super(TwoBallsWorld, self).__init__()
+        self.speed = speed
+
+    def load_scene(self):
+
+        brick = self.create_box_collider_object(40, 20)
+        brick.tag = "brick"
+        brick.transform.position = Vector2(100, 100)
+
+        # both balls hit the brick in the same frame
+        for x in (90, 110):
+            ball = self.create_box_collider_object(10, 10)
+            ball.tag = "ball"
+            ball.transform.position = Vector2(x, 160)
+            ball.add_component(RigidBody(Vector2(0, -self.speed)))
+            ball.add_script(DestroyBricks())
+
+
+# Records the collision exit events
+class RecordExits(BehaviorScript):
+
+    def __init__(self):
+        super(RecordExits, self).__init__("record exits")
+        self.exits = list()
+
+    def collision_exit_event(self, other_collider):
+        self.exits.append(other_collider.entity.tag)
+
+
+class RestingBoxWorld(World):
+
+    def load_scene(self):
+
+        self.floor = self.create_box_collider_object(200, 20)
+        self.floor.tag = "floor"
+        self.floor.transform.position = Vector2(100, 200)
+
+        self.box = self.create_box_collider_object(10, 10)
+        self.box.tag = "box"
+        self.box.transform.position = Vector2(100, 150)
+        self.box.add_component(RigidBody())
+        self.box.rigid_body.gravity_scale = 1.0
+
+        self.recorder = RecordExits()
+        self.box.add_script(self.recorder)
+
+
+# A long floor of tiles with boxes and circles dropped along it, up to its ends. The bodies land in the
+# middle of the tiles since the seams between the tiles push them aside when the tiles are not merged.
+class TiledFloorWorld(World):
+
+    def load_scene(self):
+
+        for column in range(50):
+            tile = self.create_box_collider_object(20, 20)
+            tile.tag = "tile"
+            tile.transform.position = Vector2(column * 20 + 10, 600)
+
+        self.bodies = list()
+        for i in range(10):
+
+            if i % 3 == 2:
+                body = self.create_circle_collider_object(5)
+            else:
+                body = self.create_box_collider_object(10, 10)
+
+            body.transform.position = Vector2(10 + 20 * (i * 49 // 9), 300)
+            body.add_component(RigidBody())
+            body.rigid_body.gravity_scale = 1.0
+            self.bodies.append(body)
+
+
+def load_world(world):
+    engine = Engine(600, 400)
+    engine.set_world(world)
+    world.engine = engine
+    world.start_scene_loading()
+    engine.delta_time = 1.0 / 60.0
+    return world.get_system(PhysicsSystem.tag)
+
+
+def step(world, physics, frames):
+    for i in range(frames):
+        physics.process(world.entity_manager.entities)
+
+
+class DestroyDuringFrameTest(unittest.TestCase):
+
+    def check_brick_destroyed_once(self, speed, setup):
+        world = TwoBallsWorld(speed)
+        physics = load_world(world)
+        setup(physics)
+
+        step(world, physics, 30)
+
+        self.assertEqual(["ball", "ball"], [e.tag for e in world.entity_manager.entities])
+
+    def test_sequential(self):
+        self.check_brick_destroyed_once(300, lambda physics: None)
+
+    def test_batched(self):
+        self.check_brick_destroyed_once(300, lambda physics: setattr(physics, "batch_narrowphase", BatchNarrowphase()))
+
+    def test_substeps(self):
+        self.check_brick_destroyed_once(3000, lambda physics: setattr(physics, "allow_substeps", True))
+
+    def test_continuous(self):
+        def setup(physics):
+            for e in physics.world.entity_manager.entities:
+                if e.rigid_body is not None:
+                    e.rigid_body.continuous = True
+
+        self.check_brick_destroyed_once(3000, setup)
+
+
+class RemovedContactTest(unittest.TestCase):
+
+    def test_exit_event(self):
+        world = RestingBoxWorld()
+        physics = load_world(world)
+        physics.allow_sleeping = False
+
+        # a resting box only collides every few frames, stop on a frame where it touches the floor
+        step(world, physics, 60)
+        for i in range(10):
+            if physics.contact_manager.previous_table:
+                break
+            step(world, physics, 1)
+
+        self.assertEqual(["box"], [e.tag for e in physics.contact_manager.get_touching(world.floor)])
+        exits = len(world.recorder.exits)
+
+        world.destroy_entity(world.floor)
+
+        self.assertEqual(exits + 1, len(world.recorder.exits))
+        self.assertEqual("floor", world.recorder.exits[-1])
+        self.assertEqual([], physics.contact_manager.get_touching(world.box))
+
+        # the box falls once the floor is gone
+        y = world.box.transform.position.y
+        step(world, physics, 10)
+        self.assertGreater(world.box.transform.position.y, y)
+        self.assertEqual(exits + 1, len(world.recorder.exits))
+
+
+class SleepingTest(unittest.TestCase):
+
+    # A resting box only collides every few frames, so depending on the sleep frames
+    # it falls asleep with or without a contact with the floor
+    def sleep_on_floor(self, sleep_frames):
+        world = RestingBoxWorld()
+        physics = load_world(world)
+        physics.sleep_frames = sleep_frames
+
+        step(world, physics, 120)
+        self.assertTrue(world.box.rigid_body.sleeping)
+
+        return world, physics
+
+    def test_wake_on_removal(self):
+        for sleep_frames in range(60, 64):
+            world, physics = self.sleep_on_floor(sleep_frames)
+
+            world.destroy_entity(world.floor)
+            self.assertFalse(world.box.rigid_body.sleeping)
+
+            y = world.box.transform.position.y
+            step(world, physics, 10)
+            self.assertGreater(world.box.transform.position.y, y + 1)
+
+    def test_wake_on_move(self):
+        for sleep_frames in range(60, 64):
+            world, physics = self.sleep_on_floor(sleep_frames)
+
+            world.floor.transform.position.x += 300
+            physics.entity_changed(world.floor)
+
+            y = world.box.transform.position.y
+            step(world, physics, 10)
+            self.assertFalse(world.box.rigid_body.sleeping)
+            self.assertGreater(world.box.transform.position.y, y + 1)
+
+
+class MergedStaticCollidersTest(unittest.TestCase):
+
+    def get_resting_positions(self, merge, batched):
+        world = TiledFloorWorld()
+        physics = world.get_system(PhysicsSystem.tag)
+        physics.merge_static_colliders = merge
+        if batched:
+            physics.batch_narrowphase = BatchNarrowphase()
+
+        physics = load_world(world)
+        if merge:
+            self.assertEqual(1, len(physics.merged_entities))
+
+        step(world, physics, 300)
+        return [(e.transform.position.x, e.transform.position.y) for e in world.bodies]
+
+    # the resting bodies bounce by a fraction of a pixel, so they only have to rest within a pixel
+    def test_bodies_rest_in_the_same_places(self):
+        for batched in (False, True):
+
+            expected = self.get_resting_positions(False, batched)
+            found = self.get_resting_positions(True, batched)
+
+            for (expected_x, expected_y), (x, y) in zip(expected, found):
+                self.assertAlmostEqual(expected_x, x, delta=1)
+                self.assertAlmostEqual(expected_y, y, delta=1)
+
+
+if __name__ == "__main__":
+    unittest.main()